@@ -0,0 +1,73 @@
+"""Signed per-user session tokens for the user-scoped endpoints.
+
+`/callback` issues a token once Spotify has proven who the user is, and sets
+it as an HTTP-only cookie. Scripts can send the same value as
+`Authorization: Bearer <token>`. A token is `<spotify id>.<expiry>.<HMAC>`
+signed with SESSION_SECRET, so no server-side session store is needed.
+Without SESSION_SECRET the protected endpoints refuse every request.
+"""
+
+import os
+import hmac
+import time
+import base64
+import hashlib
+from typing import Optional
+
+from fastapi import HTTPException, Request
+
+SESSION_COOKIE = "recapify_session"
+SESSION_TTL = int(os.getenv("SESSION_TTL_SECONDS", 30 * 24 * 3600))
+
+
+def sessions_configured() -> bool:
+    return bool(os.getenv("SESSION_SECRET"))
+
+
+def _secret() -> bytes:
+    secret = os.getenv("SESSION_SECRET")
+    if not secret:
+        raise HTTPException(status_code=503, detail="Sessions are not configured")
+    return secret.encode()
+
+
+def _sign(payload: str) -> str:
+    digest = hmac.new(_secret(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def issue_token(spotify_user_id: str, ttl: int = SESSION_TTL) -> str:
+    user_part = base64.urlsafe_b64encode(spotify_user_id.encode()).decode().rstrip("=")
+    payload = f"{user_part}.{int(time.time()) + ttl}"
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_token(token: str) -> Optional[str]:
+    """Return the Spotify user id a valid, unexpired token was issued for."""
+    try:
+        user_part, expires, signature = token.split(".")
+        if int(expires) < time.time():
+            return None
+    except ValueError:
+        return None
+    if not hmac.compare_digest(signature, _sign(f"{user_part}.{expires}")):
+        return None
+    padding = "=" * (-len(user_part) % 4)
+    return base64.urlsafe_b64decode(user_part + padding).decode()
+
+
+def session_user(request: Request) -> str:
+    """FastAPI dependency: the Spotify user id of the caller, or 401."""
+    token = request.cookies.get(SESSION_COOKIE)
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        token = header[len("Bearer "):]
+    spotify_user_id = verify_token(token) if token else None
+    if spotify_user_id is None:
+        raise HTTPException(status_code=401, detail="Not signed in")
+    return spotify_user_id
+
+
+def require_same_user(caller: str, spotify_user_id: str):
+    if caller != spotify_user_id:
+        raise HTTPException(status_code=403, detail="Not allowed for this user")
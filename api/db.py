@@ -1,5 +1,5 @@
-from sqlmodel import create_engine, Session
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 from urllib.parse import quote_plus
 
@@ -7,9 +7,18 @@ load_dotenv()
 password = quote_plus(os.getenv("DB_PASSWORD", ""))
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL, echo=True) #type: ignore
+
+@lru_cache(maxsize=1)
+def get_engine():
+    """Create the engine on first use rather than at import time."""
+    from sqlmodel import create_engine
+
+    echo = os.getenv("SQL_ECHO", "").lower() in ("1", "true", "yes")
+    return create_engine(DATABASE_URL, echo=echo)  # type: ignore
 
 
 def get_session():
-    with Session(engine) as session:
+    from sqlmodel import Session
+
+    with Session(get_engine()) as session:
         yield session
@@ -0,0 +1,140 @@
+"""Background processing of streaming-history uploads.
+
+Uploads are written to UPLOAD_DIR by the request handler, then imported by a
+process pool so JSON parsing and COPY traffic never run on request workers.
+Job state lives in the `import_jobs` table, which lets any API replica
+answer status requests for any job.
+
+The pool only lives as long as the API process, so each upload file is named
+after the job and the pid of the API process that queued it. On startup,
+`recover_orphaned_jobs` fails the jobs whose process is gone and deletes
+their files. UPLOAD_DIR must be local to the host for this to work.
+"""
+
+import os
+import glob
+import time
+import uuid
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", 2))
+PROGRESS_INTERVAL = 2.0  # seconds between job row updates
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn: don't inherit the server's event loop and sockets
+        _executor = ProcessPoolExecutor(
+            max_workers=IMPORT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=False)
+        _executor = None
+
+
+def new_upload_path() -> tuple[str, str]:
+    """Return a fresh (job_id, file path) pair for an incoming upload."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    job_id = uuid.uuid4().hex
+    return job_id, os.path.join(UPLOAD_DIR, f"{job_id}.{os.getpid()}.upload")
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def recover_orphaned_jobs() -> int:
+    """Fail jobs queued by API processes that no longer exist.
+
+    Their pool died with them, so they would otherwise stay queued/running
+    forever with their upload left on disk. Returns the number of files
+    cleaned up.
+    """
+    from app import db
+
+    orphans = {}
+    for path in glob.glob(os.path.join(UPLOAD_DIR, "*.upload")):
+        job_id, _, owner = os.path.basename(path)[: -len(".upload")].partition(".")
+        # Our own pid here means a previous process that had the same pid
+        if owner.isdigit() and int(owner) != os.getpid() and _process_alive(int(owner)):
+            continue
+        orphans[job_id] = path
+    if not orphans:
+        return 0
+
+    conn = db.get_conn()
+    try:
+        db.fail_import_jobs(
+            conn, list(orphans), "API restarted before the import finished"
+        )
+    finally:
+        conn.close()
+    for path in orphans.values():
+        os.remove(path)
+    logger.warning(f"Failed {len(orphans)} orphaned import job(s)")
+    return len(orphans)
+
+
+def submit_import(job_id: str, spotify_user_id: str, path: str):
+    get_executor().submit(run_import_job, job_id, spotify_user_id, path)
+
+
+def run_import_job(job_id: str, spotify_user_id: str, path: str):
+    """Import an uploaded archive, recording progress on the job row.
+
+    Runs inside a pool process.
+    """
+    from app import db
+    from app.history_import import import_history
+
+    conn = db.get_conn()
+    last_update = 0.0
+    records_read = plays_loaded = 0
+
+    def on_progress(progress):
+        nonlocal last_update, records_read, plays_loaded
+        records_read, plays_loaded = progress.records_read, progress.plays_loaded
+        now = time.monotonic()
+        if now - last_update >= PROGRESS_INTERVAL:
+            db.update_import_job(
+                conn, job_id, "running", progress.records_read, progress.plays_loaded
+            )
+            last_update = now
+
+    try:
+        db.update_import_job(conn, job_id, "running")
+        progress = import_history(spotify_user_id, path, on_progress=on_progress)
+        db.update_import_job(
+            conn, job_id, "done", progress.records_read, progress.plays_loaded
+        )
+    except Exception as e:
+        logger.error(f"Import job {job_id} failed: {e}")
+        conn.rollback()
+        db.update_import_job(
+            conn, job_id, "failed", records_read, plays_loaded, error=str(e)
+        )
+    finally:
+        conn.close()
+        if os.path.exists(path):
+            os.remove(path)
@@ -1,13 +1,27 @@
 import os
 import secrets
 import logging
-from typing import Optional
+from datetime import date
+from typing import TYPE_CHECKING, Optional
 from fastapi import FastAPI, Request, Depends, HTTPException
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from dotenv import load_dotenv
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-from spotipy.exceptions import SpotifyException, SpotifyOauthError
+
+from .auth import (
+    SESSION_COOKIE,
+    SESSION_TTL,
+    issue_token,
+    require_same_user,
+    session_user,
+    sessions_configured,
+)
+
+# spotipy, the DB driver and the import pipeline are imported inside the
+# handlers that need them so a cold start only pays for FastAPI itself.
+
+if TYPE_CHECKING:
+    from spotipy.oauth2 import SpotifyOAuth
 
 # from sqlmodel import Session, select
 # from models import Users
@@ -31,7 +45,7 @@ ERROR_MESSAGES = {
     "database_error": "Database operation failed",
 }
 
-# Validate environment variables
+# Required environment variables, checked lazily by validate_env()
 REQUIRED_ENV_VARS = [
     "CLIENT_ID",
     "CLIENT_SECRET",
@@ -39,15 +53,21 @@ REQUIRED_ENV_VARS = [
     "SCOPES",
 ]
 
-missing_vars = [var for var in REQUIRED_ENV_VARS if not os.getenv(var)]
-if missing_vars:
-    raise RuntimeError(
-        f"Missing required environment variables: {', '.join(missing_vars)}"
-    )
+
+def validate_env():
+    """Fail loudly on the first OAuth request if configuration is missing."""
+    missing_vars = [var for var in REQUIRED_ENV_VARS if not os.getenv(var)]
+    if missing_vars:
+        raise RuntimeError(
+            f"Missing required environment variables: {', '.join(missing_vars)}"
+        )
 
 
-def create_spotify_oauth(state: Optional[str] = None) -> SpotifyOAuth:
+def create_spotify_oauth(state: Optional[str] = None) -> "SpotifyOAuth":
     """Create SpotifyOAuth instance with consistent configuration."""
+    from spotipy.oauth2 import SpotifyOAuth
+
+    validate_env()
     if os.path.isfile('.cache'):
         os.remove(f'.cache')
     return SpotifyOAuth(
@@ -97,6 +117,9 @@ async def logout():
 @app.get("/callback")
 async def callback(request: Request):
     """Handle Spotify OAuth callback."""
+    import spotipy
+    from spotipy.exceptions import SpotifyException, SpotifyOauthError
+
     try:
         # Log incoming request parameters
         logger.info(f"Callback received with params: {dict(request.query_params)}")
@@ -190,7 +213,21 @@ async def callback(request: Request):
             )
 
         # return RedirectResponse("http://localhost:5173/?logged_in=1")
-        return RedirectResponse("https://recapify-site.onrender.com/?logged_in=1")
+        response = RedirectResponse("https://recapify-site.onrender.com/?logged_in=1")
+        # Signup must keep working where sessions were never set up; only the
+        # session-protected endpoints need SESSION_SECRET
+        if sessions_configured():
+            response.set_cookie(
+                SESSION_COOKIE,
+                issue_token(user_id),
+                max_age=SESSION_TTL,
+                httponly=True,
+                secure=True,
+                samesite="lax",
+            )
+        else:
+            logger.warning("SESSION_SECRET is not set; signed up without a session")
+        return response
 
     except HTTPException:
         # Re-raise HTTP exceptions
@@ -238,17 +275,134 @@ async def debug_users():
 
 @app.get("/debug/init-db")
 async def debug_init_db():
-    """Debug endpoint to initialize the database."""
+    """Debug endpoint to apply pending schema migrations."""
     try:
-        from app.db import init_db
+        from app.migrations import migrate
 
-        init_db()
-        return {"status": "Database initialized successfully"}
+        applied = migrate()
+        return {"status": "Database initialized successfully", "applied": applied}
     except Exception as e:
         logger.error(f"Database init error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"DB init error: {str(e)}")
 
 
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 4 * 1024**3))
+
+
+@app.post("/users/{spotify_user_id}/history", status_code=202)
+async def upload_history(
+    spotify_user_id: str, request: Request, caller: str = Depends(session_user)
+):
+    """Accept a streaming-history export and import it in the background.
+
+    The archive is sent as the raw request body and streamed to disk chunk by
+    chunk, so request workers never hold more than one chunk in memory.
+    Only the signed-in user can upload their own history.
+    """
+    from app.db import get_conn, get_user_by_spotify_id, create_import_job
+    from .jobs import new_upload_path, submit_import
+
+    require_same_user(caller, spotify_user_id)
+    user = await run_in_threadpool(get_user_by_spotify_id, spotify_user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    job_id, path = new_upload_path()
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="Upload too large")
+                await run_in_threadpool(f.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    if size == 0:
+        os.remove(path)
+        raise HTTPException(status_code=400, detail="Empty upload")
+
+    try:
+        conn = get_conn()
+        try:
+            create_import_job(conn, job_id, user["id"])
+        finally:
+            conn.close()
+    except Exception as e:
+        os.remove(path)
+        logger.error(f"Database error: {str(e)}")
+        raise HTTPException(status_code=500, detail=ERROR_MESSAGES["database_error"])
+
+    submit_import(job_id, spotify_user_id, path)
+    logger.info(f"Queued history import {job_id} for {spotify_user_id} ({size} bytes)")
+    return {"job_id": job_id, "status": "queued", "bytes": size}
+
+
+@app.get("/jobs/{job_id}")
+async def import_job_status(job_id: str, caller: str = Depends(session_user)):
+    """Report progress of one of the signed-in user's history import jobs."""
+    from app.db import get_import_job
+
+    job = await run_in_threadpool(get_import_job, job_id)
+    # Someone else's job looks the same as a missing one
+    if job is None or job["spotify_user_id"] != caller:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/users/{spotify_user_id}/reports/{year}/{week}", response_class=HTMLResponse)
+async def weekly_report(
+    spotify_user_id: str, year: int, week: int, caller: str = Depends(session_user)
+):
+    """Render a user's weekly report for an ISO year/week.
+
+    Served from the weekly data cache, which the startup listener keeps in
+    step with new plays. Only the signed-in user can read their own reports.
+    """
+    from app.db import get_user_by_spotify_id
+    from app.generate_report import generate_user_weekly_report
+
+    require_same_user(caller, spotify_user_id)
+    try:
+        date.fromisocalendar(year, week, 1)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="No such ISO week")
+    user = await run_in_threadpool(get_user_by_spotify_id, spotify_user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return await run_in_threadpool(generate_user_weekly_report, user["id"], year, week)
+
+
+@app.on_event("startup")
+async def recover_import_jobs():
+    from .jobs import recover_orphaned_jobs
+
+    await run_in_threadpool(recover_orphaned_jobs)
+
+
+@app.on_event("startup")
+async def start_cache_listener():
+    from app.cache import start_invalidation_listener
+
+    start_invalidation_listener()
+
+
+@app.on_event("shutdown")
+async def shutdown_import_workers():
+    from .jobs import shutdown_executor
+
+    shutdown_executor()
+
+
+@app.on_event("shutdown")
+async def stop_cache_listener():
+    from app.cache import stop_invalidation_listener
+
+    await run_in_threadpool(stop_invalidation_listener)
+
+
 # Error handlers
 
 
@@ -1,67 +1,91 @@
 # aggregator.py
+from dataclasses import dataclass
 from datetime import date, timedelta
-from .db import get_conn
+from .db import get_read_conn
 
+# Advisory lock namespace for per-user rollup refreshes (key: user id)
+ROLLUP_LOCK_ID = 7_253_002
 
-def load_weekly_data(user_id: int, week_start: date, week_end: date) -> dict:
-    """Fetch tracks, artists, and user info from DB for a given week."""
-    conn = get_conn()
-    data = {"tracks": {}, "artists": {}, "user": None}
+
+# One report can list thousands of rows, and the bulk renderer builds
+# thousands of reports per process: slotted rows cost a fraction of a dict
+# each. Field names are what templates/weekly_report.html reads.
+@dataclass(slots=True, frozen=True)
+class TrackRow:
+    track_id: str
+    name: str
+    artist_name: str
+    artist_id: str
+    album_image: str
+    count: int
+
+
+@dataclass(slots=True, frozen=True)
+class ArtistRow:
+    id: str
+    name: str
+    artist_image: str
+    count: int
+
+
+# Both queries are shaped to be answered from indexes alone:
+# uq_plays_user_time_track for plays, idx_tracks_cover and idx_artists_cover
+# for the joins (see migrations 8 and benchmarks/check_query_plans.py).
+# tracks/artists are a shared catalog keyed by Spotify id, so each play
+# joins exactly one row and grouping by the keys is enough. Rows come back
+# ranked (ties broken by id) so callers never sort them again.
+WEEKLY_TRACKS_SQL = """
+SELECT
+    t.id AS track_id,
+    t.name,
+    a.name AS artist_name,
+    a.id AS artist_id,
+    t.album_image,
+    COUNT(*) AS count
+FROM plays p
+JOIN tracks t ON p.track_id = t.id
+JOIN artists a ON t.artist_id = a.id
+WHERE p.user_id = %s AND p.played_at >= %s AND p.played_at < %s
+GROUP BY t.id, a.id
+ORDER BY count DESC, t.id
+"""
+
+WEEKLY_ARTISTS_SQL = """
+SELECT
+    a.id AS artist_id,
+    a.name,
+    a.image_url,
+    COUNT(*) AS count
+FROM plays p
+JOIN tracks t ON p.track_id = t.id
+JOIN artists a ON t.artist_id = a.id
+WHERE p.user_id = %s AND p.played_at >= %s AND p.played_at < %s
+GROUP BY a.id
+ORDER BY count DESC, a.id
+"""
+
+
+def load_weekly_data(user_id: int, week_start: date, week_end: date, conn=None) -> dict:
+    """Fetch tracks, artists, and user info from DB for a given week.
+
+    `tracks` and `artists` are tuples of TrackRow/ArtistRow, most played
+    first, so the top N is a slice. Read-only, so it runs on a replica
+    when one is configured.
+    """
+    close_conn = False
+    if conn is None:
+        conn = get_read_conn()
+        close_conn = True
+    data = {"tracks": (), "artists": (), "user": None}
     try:
         with conn.cursor() as cur:
             # Top tracks
-            cur.execute(
-                """
-                SELECT
-                    t.id AS track_id,
-                    t.name,
-                    a.name AS artist_name,
-                    a.id AS artist_id,
-                    t.album_image,
-                    COUNT(*) AS count
-                FROM plays p
-                JOIN tracks t ON p.track_id = t.id
-                JOIN artists a ON t.artist_id = a.id
-                WHERE p.user_id = %s AND p.played_at >= %s AND p.played_at < %s
-                GROUP BY t.id, t.name, a.name, a.id, t.album_image
-                """,
-                (user_id, week_start, week_end),
-            )
-            for row in cur.fetchall():
-                track_id, name, artist_name, artist_id, album_image, count = row
-                data["tracks"][track_id] = {
-                    "track_id": track_id,
-                    "name": name,
-                    "artist_name": artist_name,
-                    "artist_id": artist_id,
-                    "album_image": album_image,
-                    "count": count,
-                }
+            cur.execute(WEEKLY_TRACKS_SQL, (user_id, week_start, week_end))
+            data["tracks"] = tuple(TrackRow(*row) for row in cur)
 
             # Top artists
-            cur.execute(
-                """
-                SELECT
-                    a.id AS artist_id,
-                    a.name,
-                    a.image_url,
-                    COUNT(*) AS count
-                FROM plays p
-                JOIN tracks t ON p.track_id = t.id
-                JOIN artists a ON t.artist_id = a.id
-                WHERE p.user_id = %s AND p.played_at >= %s AND p.played_at < %s
-                GROUP BY a.id, a.name, a.image_url
-                """,
-                (user_id, week_start, week_end),
-            )
-            for row in cur.fetchall():
-                artist_id, name, artist_image, count = row
-                data["artists"][artist_id] = {
-                    "id": artist_id,
-                    "name": name,
-                    "artist_image": artist_image,
-                    "count": count,
-                }
+            cur.execute(WEEKLY_ARTISTS_SQL, (user_id, week_start, week_end))
+            data["artists"] = tuple(ArtistRow(*row) for row in cur)
 
             # User info
             cur.execute(
@@ -75,7 +99,8 @@ def load_weekly_data(user_id: int, week_start: date, week_end: date) -> dict:
                 raise ValueError(f"User with ID {user_id} not found")
 
     finally:
-        conn.close()
+        if close_conn:
+            conn.close()
 
     return data
 
@@ -85,3 +110,90 @@ def get_week_range(today: date = date.today()):
     week_start = today - timedelta(days=today.weekday())
     week_end = week_start + timedelta(days=7)
     return week_start, week_end
+
+
+def _rollup_filter(time_column: str, user_column: str, since, user_ids):
+    """Build a WHERE clause and params limiting rollup work to a scope."""
+    clauses = ["TRUE"]
+    params: list = []
+    if since is not None:
+        clauses.append(f"{time_column} >= %s")
+        params.append(since)
+    if user_ids is not None:
+        clauses.append(f"{user_column} = ANY(%s)")
+        params.append(list(user_ids))
+    return " AND ".join(clauses), params
+
+
+def lock_user_rollups(conn, user_ids=None):
+    """Take the rollup lock of each user (all users when None) until commit.
+
+    The ETL writer, the scheduler and history imports can refresh the same
+    user at once; without the lock the second DELETE + INSERT hits the
+    rollup primary keys. Locks are taken in id order so two refreshes
+    can't deadlock; callers refreshing in several steps should lock all
+    their users up front.
+    """
+    if user_ids is not None and not user_ids:
+        return
+    with conn.cursor() as cur:
+        if user_ids is None:
+            cur.execute(
+                """
+                SELECT COUNT(pg_advisory_xact_lock(%s, id))
+                FROM (SELECT id FROM users ORDER BY id) u
+                """,
+                (ROLLUP_LOCK_ID,),
+            )
+        else:
+            cur.execute(
+                """
+                SELECT COUNT(pg_advisory_xact_lock(%s, id))
+                FROM (SELECT DISTINCT id FROM unnest(%s::int[]) AS id ORDER BY id) u
+                """,
+                (ROLLUP_LOCK_ID, sorted(set(user_ids))),
+            )
+
+
+def refresh_weekly_rollups(conn, since: date | None = None, user_ids=None):
+    """Recompute per-week track and artist counts from `plays`.
+
+    Rebuilds every week from the one containing `since` onwards (all weeks
+    when None), optionally only for `user_ids`. The caller owns the
+    transaction, which holds the users' rollup locks until it ends.
+    """
+    lock_user_rollups(conn, user_ids)
+    if since is not None:
+        since = get_week_range(since)[0]
+    plays_where, plays_params = _rollup_filter("played_at", "user_id", since, user_ids)
+    rollup_where, rollup_params = _rollup_filter(
+        "week_start", "user_id", since, user_ids
+    )
+    counts_where, counts_params = _rollup_filter(
+        "c.week_start", "c.user_id", since, user_ids
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM weekly_track_counts WHERE {rollup_where}", rollup_params)
+        cur.execute(f"DELETE FROM weekly_artist_counts WHERE {rollup_where}", rollup_params)
+        cur.execute(
+            f"""
+            INSERT INTO weekly_track_counts (user_id, week_start, track_id, plays)
+            SELECT user_id, date_trunc('week', played_at)::date, track_id, COUNT(*)
+            FROM plays
+            WHERE {plays_where}
+            GROUP BY 1, 2, 3
+            """,
+            plays_params,
+        )
+        cur.execute(
+            f"""
+            INSERT INTO weekly_artist_counts (user_id, week_start, artist_id, plays)
+            SELECT c.user_id, c.week_start, t.artist_id, SUM(c.plays)
+            FROM weekly_track_counts c
+            JOIN tracks t ON t.id = c.track_id
+            WHERE {counts_where}
+            GROUP BY 1, 2, 3
+            """,
+            counts_params,
+        )
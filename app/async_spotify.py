@@ -0,0 +1,222 @@
+"""Minimal asyncio Spotify client for the ingestion path.
+
+Covers only what ingestion needs: refreshing a user's access token, the
+profile, recently-played and batched artist lookups. All requests share one
+aiohttp session whose connector keeps HTTP/1.1 connections alive and caps
+connections per host, so hundreds of users can be in flight from one event
+loop without a thread (or a TLS handshake) per request.
+
+Errors mirror spotipy's split: `SpotifyAuthError` for the token endpoint
+(with the OAuth `error` code, e.g. "invalid_grant") and `SpotifyApiError`
+for the Web API, so token health can be tracked the same way.
+"""
+
+import os
+import math
+import asyncio
+import logging
+from typing import Callable, Optional
+
+import aiohttp
+from dotenv import load_dotenv
+
+from .pull_data import (
+    ARTIST_BATCH_LIMIT,
+    PlayBatch,
+    UserFailure,
+    artist_images,
+    batch_from_recent,
+)
+
+load_dotenv()
+
+API_URL = "https://api.spotify.com/v1"
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+MAX_CONNECTIONS = int(os.getenv("SPOTIFY_MAX_CONNECTIONS", 200))
+MAX_CONNECTIONS_PER_HOST = int(os.getenv("SPOTIFY_MAX_CONNECTIONS_PER_HOST", 100))
+KEEPALIVE_TIMEOUT = 30.0  # seconds an idle pooled connection is kept
+REQUEST_TIMEOUT = 30.0
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 0.5  # doubled per retry on 5xx/connection errors
+MAX_RETRY_AFTER = 60.0  # cap on a 429 Retry-After we are willing to sleep
+
+
+class SpotifyApiError(Exception):
+    def __init__(self, http_status: int, message: str):
+        super().__init__(f"http status: {http_status}, {message}")
+        self.http_status = http_status
+
+
+class SpotifyAuthError(SpotifyApiError):
+    def __init__(self, http_status: int, error: Optional[str], description: str = ""):
+        super().__init__(http_status, f"{error}: {description}")
+        self.error = error
+
+
+def failure_for(user, exc: Exception) -> Optional[UserFailure]:
+    """Async counterpart of `pull_data.failure_for` for this client's errors.
+
+    Only errors Spotify returned count against the user. Transport errors
+    and timeouts (which include waiting for a pooled connection) don't.
+    """
+    if isinstance(exc, SpotifyAuthError):
+        permanent = exc.error == "invalid_grant"
+    elif isinstance(exc, SpotifyApiError):
+        permanent = False
+    else:
+        return None
+    return UserFailure(user["id"], type(exc).__name__, permanent)
+
+
+class AsyncSpotify:
+    """Shared-session Spotify client; use as `async with AsyncSpotify() as sp`."""
+
+    def __init__(
+        self,
+        client_id: Optional[str] = None,
+        client_secret: Optional[str] = None,
+        max_connections: int = MAX_CONNECTIONS,
+        max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST,
+    ):
+        self.client_id = client_id or os.getenv("CLIENT_ID")
+        self.client_secret = client_secret or os.getenv("CLIENT_SECRET")
+        if not self.client_id or not self.client_secret:
+            raise ValueError("Missing Spotify credentials. Check your .env file.")
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "AsyncSpotify":
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections,
+            limit_per_host=self.max_connections_per_host,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            raise_for_status=False,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._session = None
+
+    async def _request(self, method: str, url: str, **kwargs) -> dict:
+        """Send a request, honouring 429 Retry-After and retrying 5xx."""
+        for attempt in range(MAX_RETRIES + 1):
+            last_try = attempt == MAX_RETRIES
+            try:
+                async with self._session.request(method, url, **kwargs) as response:
+                    if response.status == 429 and not last_try:
+                        delay = float(response.headers.get("Retry-After", 1))
+                        await asyncio.sleep(min(delay, MAX_RETRY_AFTER))
+                        continue
+                    if response.status >= 500 and not last_try:
+                        await asyncio.sleep(RETRY_BASE_DELAY * 2**attempt)
+                        continue
+                    if response.status == 204:
+                        return {}
+                    body = await response.json(content_type=None)
+                    if response.status >= 400:
+                        raise self._error(url, response.status, body)
+                    return body or {}
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last_try:
+                    raise
+                await asyncio.sleep(RETRY_BASE_DELAY * 2**attempt)
+        raise AssertionError("unreachable")
+
+    @staticmethod
+    def _error(url: str, status: int, body) -> SpotifyApiError:
+        body = body if isinstance(body, dict) else {}
+        if url == TOKEN_URL:
+            return SpotifyAuthError(
+                status, body.get("error"), body.get("error_description", "")
+            )
+        error = body.get("error") or {}
+        message = error.get("message", "") if isinstance(error, dict) else str(error)
+        return SpotifyApiError(status, f"{url}: {message}")
+
+    async def refresh_access_token(self, refresh_token: str) -> dict:
+        return await self._request(
+            "POST",
+            TOKEN_URL,
+            data={"grant_type": "refresh_token", "refresh_token": refresh_token},
+            auth=aiohttp.BasicAuth(self.client_id, self.client_secret),
+        )
+
+    async def _get(self, token: str, path: str, params: Optional[dict] = None) -> dict:
+        return await self._request(
+            "GET",
+            f"{API_URL}/{path}",
+            params=params,
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
+    async def current_user(self, token: str) -> dict:
+        return await self._get(token, "me")
+
+    async def current_user_recently_played(
+        self, token: str, limit: int = 50, after: Optional[int] = None
+    ) -> dict:
+        params = {"limit": limit}
+        if after is not None:
+            params["after"] = after
+        return await self._get(token, "me/player/recently-played", params)
+
+    async def artists(self, token: str, artist_ids) -> list[dict]:
+        """Fetch any number of artists, ARTIST_BATCH_LIMIT ids per request."""
+        artist_ids = list(artist_ids)
+        chunks = [
+            artist_ids[i : i + ARTIST_BATCH_LIMIT]
+            for i in range(0, len(artist_ids), ARTIST_BATCH_LIMIT)
+        ]
+        responses = await asyncio.gather(
+            *(self._get(token, "artists", {"ids": ",".join(chunk)}) for chunk in chunks),
+            return_exceptions=True,
+        )
+        artists = []
+        for response in responses:
+            if isinstance(response, Exception):
+                logging.error(f"Error fetching artist images: {response}")
+                continue
+            artists.extend(response.get("artists") or [])
+        return artists
+
+
+async def fetch_user_batch(
+    sp: AsyncSpotify,
+    user,
+    known_artist_ids: Callable[[set], set],
+    after: Optional[int] = None,
+) -> Optional[PlayBatch]:
+    """Async counterpart of `pull_data.fetch_user_batch`."""
+    token_info = await sp.refresh_access_token(user["refresh_token"])
+    token = token_info["access_token"]
+    profile = await sp.current_user(token)
+    if not profile.get("id"):
+        raise ValueError(
+            f"Could not fetch user profile from Spotify for user {user.get('spotify_user_id', 'unknown')}."
+        )
+
+    recent = await sp.current_user_recently_played(token, limit=50, after=after)
+    if not recent.get("items"):
+        logging.info(f"No recent plays found for user {user['spotify_user_id']}.")
+        return None
+
+    batch, artist_names = batch_from_recent(user, recent["items"])
+    # The lookup may hit the DB, so keep it off the event loop
+    known = await asyncio.to_thread(known_artist_ids, set(artist_names))
+    new_artists = set(artist_names) - known
+    images = artist_images(await sp.artists(token, new_artists)) if new_artists else {}
+    batch.artist_calls = math.ceil(len(new_artists) / ARTIST_BATCH_LIMIT)
+    # Every artist goes in the batch; known ones just skip the image lookup
+    batch.artists = [
+        (artist_id, name, images.get(artist_id, ""))
+        for artist_id, name in artist_names.items()
+    ]
+    return batch
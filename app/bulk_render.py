@@ -0,0 +1,196 @@
+"""Render every user's weekly report into one compressed archive.
+
+Reports are rendered by a pool of processes. Each worker compiles the
+template once (inherited from the parent under fork) and keeps one
+read-only DB connection for all its users. The parent streams finished
+reports straight into a .tar.gz as they arrive, so memory stays flat no
+matter how many users there are. An `index.json` listing every user, their
+file and any render error is written as the last member.
+
+Used for QA and archival, and to preview a week at full scale before
+send_report.py emails it.
+"""
+
+import io
+import os
+import json
+import time
+import logging
+import tarfile
+import multiprocessing
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+from .db import get_all_users, get_read_conn
+from .aggregator import load_weekly_data
+from .listening_stats import load_listening_stats
+from .generate_report import (
+    OUTPUT_DIR,
+    TEMPLATE_NAME,
+    generate_html_report,
+    report_filename,
+    report_week,
+    setup_jinja_env,
+)
+
+PROCESSES = int(os.getenv("RENDER_PROCESSES", os.cpu_count() or 1))
+CHUNK_SIZE = 16  # users handed to a worker at a time
+COMPRESS_LEVEL = 6
+USER_FIELDS = ("id", "spotify_user_id", "display_name", "email")
+
+# Per-process state: the template is set by _init_worker, the connection
+# is opened by the first _render so a DB outage fails reports, not the pool
+_conn = None
+_template_name = TEMPLATE_NAME
+
+
+@dataclass
+class RenderStats:
+    users: int = 0
+    rendered: int = 0
+    failed: int = 0
+    html_bytes: int = 0
+    archive_bytes: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def reports_per_second(self) -> float:
+        return self.rendered / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def html_mb_per_second(self) -> float:
+        return self.html_bytes / 1e6 / self.elapsed if self.elapsed else 0.0
+
+
+@dataclass
+class RenderResult:
+    user_id: int
+    spotify_user_id: str
+    display_name: Optional[str]
+    email: Optional[str]
+    file: Optional[str] = None
+    bytes: int = 0
+    error: Optional[str] = None
+    html: bytes = field(default=b"", repr=False)
+
+
+def _init_worker(template_name: str):
+    global _conn, _template_name
+    _template_name = template_name
+    # No-op when the compiled template was inherited from the parent
+    setup_jinja_env().get_template(template_name)
+    # An inherited connection belongs to the parent; never share it
+    _conn = None
+
+
+def _render(job: tuple[dict, int, int, int]) -> RenderResult:
+    global _conn
+    user, year, week, top_n = job
+    result = RenderResult(
+        user_id=user["id"],
+        spotify_user_id=user["spotify_user_id"],
+        display_name=user["display_name"],
+        email=user["email"],
+    )
+    week_start, week_end, display_date = report_week(year, week)
+    try:
+        if _conn is None:
+            _conn = get_read_conn()
+        data = load_weekly_data(user["id"], week_start, week_end, conn=_conn)
+        listening = load_listening_stats(
+            user["id"], week_start, week_end, today=display_date, conn=_conn
+        )
+        html = generate_html_report(
+            data,
+            top_n=top_n,
+            template_name=_template_name,
+            year=year,
+            week=week,
+            today=display_date,
+            listening=listening,
+        )
+        result.html = html.encode("utf-8")
+        result.bytes = len(result.html)
+        result.file = f"{year}-W{week:02d}/{report_filename(year, week, user['id'])}"
+    except Exception as e:
+        result.error = str(e)
+    finally:
+        # Don't hold one snapshot open for the worker's whole run; a broken
+        # connection is dropped and reopened by the next report
+        try:
+            if _conn is not None:
+                _conn.rollback()
+        except Exception:
+            _conn = None
+    return result
+
+
+def _add_member(tar: tarfile.TarFile, name: str, payload: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(payload))
+
+
+def default_archive_path(year: int, week: int, out_dir: str = OUTPUT_DIR) -> str:
+    return os.path.join(out_dir, f"weekly_reports_{year}_w{week:02d}.tar.gz")
+
+
+def render_week_archive(
+    year: int,
+    week: int,
+    out: Optional[str] = None,
+    top_n: int = 5,
+    processes: int = PROCESSES,
+    template_name: str = TEMPLATE_NAME,
+) -> RenderStats:
+    """Render all users' reports for an ISO week into a .tar.gz at `out`."""
+    out = out or default_archive_path(year, week)
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    report_week(year, week)  # reject a bad year/week before starting workers
+
+    users = get_all_users()
+    stats = RenderStats(users=len(users))
+    index = []
+
+    # Compile before the pool starts so forked workers inherit it
+    setup_jinja_env().get_template(template_name)
+    method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    ctx = multiprocessing.get_context(method)
+
+    started = time.perf_counter()
+    with tarfile.open(out, "w:gz", compresslevel=COMPRESS_LEVEL) as tar:
+        with ctx.Pool(
+            processes, initializer=_init_worker, initargs=(template_name,)
+        ) as pool:
+            # Workers only need what goes in the index, not tokens
+            jobs = (
+                ({key: user[key] for key in USER_FIELDS}, year, week, top_n)
+                for user in users
+            )
+            for result in pool.imap_unordered(_render, jobs, chunksize=CHUNK_SIZE):
+                if result.error is None:
+                    _add_member(tar, result.file, result.html)
+                    stats.rendered += 1
+                    stats.html_bytes += result.bytes
+                else:
+                    logging.error(
+                        f"Failed to render report for user {result.user_id}: {result.error}"
+                    )
+                    stats.failed += 1
+                result.html = b""
+                index.append({k: v for k, v in asdict(result).items() if k != "html"})
+
+        index.sort(key=lambda entry: entry["user_id"])
+        manifest = {"year": year, "week": week, "users": index}
+        _add_member(tar, "index.json", json.dumps(manifest, indent=2).encode("utf-8"))
+    stats.elapsed = time.perf_counter() - started
+    stats.archive_bytes = os.path.getsize(out)
+
+    logging.info(
+        f"Rendered {stats.rendered}/{stats.users} reports ({stats.failed} failed) "
+        f"in {stats.elapsed:.1f}s: {stats.reports_per_second:.1f} reports/s, "
+        f"{stats.html_mb_per_second:.1f} MB/s of HTML, "
+        f"archive {stats.archive_bytes / 1e6:.1f} MB at {out}"
+    )
+    return stats
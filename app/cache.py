@@ -0,0 +1,206 @@
+"""Weekly report data cache kept fresh by Postgres LISTEN/NOTIFY.
+
+Every write path that adds plays calls `db.notify_plays_changed`, which
+NOTIFYs `db.PLAYS_CHANNEL` with the affected (user_id, week_start) pairs
+when its transaction commits. `InvalidationListener` LISTENs on the primary
+(notifications are not replicated) and evicts exactly those entries, so
+entries can live for hours instead of minutes.
+
+The cache only serves hits while a listener is connected. Before the first
+LISTEN, and after a dropped connection (when notifications may have been
+missed), it is emptied and acts as a pass-through until the listener is
+back, so a process without a listener never serves stale weeks.
+
+With read replicas, a notification can arrive before the replica has
+replayed the commit. Loads of a week for `settle_seconds` after its
+invalidation are therefore served but not stored.
+"""
+
+import os
+import json
+import time
+import select
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, timedelta
+from typing import Optional
+
+from . import db
+from .aggregator import load_weekly_data
+
+CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL_SECONDS", 24 * 3600))
+CACHE_MAX_ENTRIES = int(os.getenv("REPORT_CACHE_MAX_ENTRIES", 10_000))
+# How long a replica may lag behind the NOTIFY; 0 when reads hit the primary
+SETTLE_SECONDS = db.MAX_REPLICA_LAG_SECONDS if db.REPLICA_DSNS else 0.0
+LISTEN_POLL_INTERVAL = 5.0
+RECONNECT_MAX_DELAY = 60.0
+
+
+class WeeklyDataCache:
+    """LRU + TTL cache of `load_weekly_data` results keyed by (user_id, week_start)."""
+
+    def __init__(
+        self,
+        ttl: float = CACHE_TTL,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        settle_seconds: float = SETTLE_SECONDS,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.settle_seconds = settle_seconds
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple, tuple[float, dict]] = OrderedDict()
+        # key -> token of the load in flight; evicting the key cancels the store
+        self._loading: dict[tuple, object] = {}
+        self._settling: dict[tuple, float] = {}
+
+    def get(self, user_id: int, week_start: date, week_end: date) -> dict:
+        # Only whole Monday-to-Monday weeks line up with the notifications
+        if week_start.weekday() != 0 or week_end - week_start != timedelta(days=7):
+            return load_weekly_data(user_id, week_start, week_end)
+
+        key = (user_id, week_start)
+        token = object()
+        with self._lock:
+            entry = self._entries.get(key)
+            if self.enabled and entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            self._loading[key] = token
+
+        data = load_weekly_data(user_id, week_start, week_end)
+
+        with self._lock:
+            if self._loading.get(key) is token:
+                del self._loading[key]
+                now = time.monotonic()
+                if self.enabled and self._settling.get(key, 0.0) <= now:
+                    self._settling.pop(key, None)
+                    self._entries[key] = (now + self.ttl, data)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+        return data
+
+    def invalidate(self, user_id: int, week_start: date):
+        key = (user_id, week_start)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._loading.pop(key, None)
+            if self.settle_seconds:
+                self._settling[key] = time.monotonic() + self.settle_seconds
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._loading.clear()
+            self._settling.clear()
+
+    def set_enabled(self, enabled: bool):
+        """Turn hits on or off; always starts from an empty cache."""
+        with self._lock:
+            self.enabled = enabled
+            self._entries.clear()
+            self._loading.clear()
+            self._settling.clear()
+
+
+weekly_data_cache = WeeklyDataCache()
+
+
+def load_weekly_data_cached(user_id: int, week_start: date, week_end: date) -> dict:
+    """`load_weekly_data` through the process-wide cache."""
+    return weekly_data_cache.get(user_id, week_start, week_end)
+
+
+class InvalidationListener(threading.Thread):
+    """Background thread applying play notifications to a `WeeklyDataCache`."""
+
+    def __init__(self, cache: WeeklyDataCache = weekly_data_cache):
+        super().__init__(name="cache-invalidation", daemon=True)
+        self.cache = cache
+        self.stop_event = threading.Event()
+
+    def _handle(self, payload: str):
+        try:
+            event = json.loads(payload)
+            user_id = int(event["user_id"])
+            week_start = date.fromisoformat(event["week_start"])
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Ignoring malformed notification {payload!r}: {e}")
+            return
+        self.cache.invalidate(user_id, week_start)
+
+    def _listen(self):
+        conn = db.get_conn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {db.PLAYS_CHANNEL}")
+            self.cache.set_enabled(True)
+            logging.info(f"Listening for play notifications on {db.PLAYS_CHANNEL}")
+            while not self.stop_event.is_set():
+                if select.select([conn], [], [], LISTEN_POLL_INTERVAL) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._handle(conn.notifies.pop(0).payload)
+        finally:
+            self.cache.set_enabled(False)
+            conn.close()
+
+    def run(self):
+        delay = 1.0
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self._listen()
+            except Exception as e:
+                logging.warning(f"Cache invalidation listener lost connection: {e}")
+            if time.monotonic() - started > RECONNECT_MAX_DELAY:
+                delay = 1.0
+            self.stop_event.wait(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def stop(self, timeout: Optional[float] = None):
+        self.stop_event.set()
+        self.join(timeout)
+
+
+_listener: Optional[InvalidationListener] = None
+_listener_lock = threading.Lock()
+
+
+def start_invalidation_listener() -> InvalidationListener:
+    """Start the process-wide listener for `weekly_data_cache` (idempotent)."""
+    global _listener
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = InvalidationListener()
+            _listener.start()
+        return _listener
+
+
+def stop_invalidation_listener(timeout: Optional[float] = LISTEN_POLL_INTERVAL + 1):
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop(timeout)
+            _listener = None
+
+
+@contextmanager
+def invalidation_listener():
+    """Run the listener for the duration of a `with` block."""
+    start_invalidation_listener()
+    try:
+        yield weekly_data_cache
+    finally:
+        stop_invalidation_listener()
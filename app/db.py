@@ -1,13 +1,44 @@
 import psycopg2
 from dotenv import load_dotenv
 import os
+import time
+import logging
+import itertools
+import threading
 from typing import Optional
+from datetime import timedelta
 from psycopg2.extras import execute_values
 
 load_dotenv()
 
+# Comma-separated libpq DSNs of streaming replicas for read-only queries
+REPLICA_DSNS = [
+    dsn.strip() for dsn in os.getenv("DB_REPLICA_DSNS", "").split(",") if dsn.strip()
+]
+MAX_REPLICA_LAG_SECONDS = float(os.getenv("DB_MAX_REPLICA_LAG_SECONDS", 30))
+REPLICA_CHECK_INTERVAL = 10.0  # seconds a replica's lag/health result is trusted
+
+# NOTIFY channel carrying {"user_id", "week_start"} for weeks with new plays
+PLAYS_CHANNEL = "recapify_plays"
+
+REPLICA_LAG_SQL = """
+SELECT CASE
+  WHEN NOT pg_is_in_recovery() THEN 0
+  -- Fully caught up: an idle primary would otherwise look like lag. Only
+  -- while streaming; a disconnected receiver's LSN stops moving, so it
+  -- would look caught up forever. (status needs pg_read_all_stats.)
+  WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+   AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming')
+  THEN 0
+  ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
 
 def get_conn():
+    """Connection to the primary; use for anything that writes."""
+    if os.getenv("DB_PRIMARY_DSN"):
+        return psycopg2.connect(os.getenv("DB_PRIMARY_DSN"))
     return psycopg2.connect(
         host=os.getenv("DB_HOST", "localhost"),
         port=int(os.getenv("DB_PORT", 5432)),
@@ -17,51 +48,93 @@ def get_conn():
     )
 
 
-# Functions for pull_data.py
+class ReplicaRouter:
+    """Round-robin read connections over replicas, falling back to primary.
+
+    A replica is skipped while it is unreachable or lagging more than
+    `max_lag` seconds; each verdict is cached for `check_interval` seconds
+    so healthy replicas aren't re-checked on every connection.
+    """
+
+    def __init__(
+        self,
+        dsns: list[str],
+        max_lag: float = MAX_REPLICA_LAG_SECONDS,
+        check_interval: float = REPLICA_CHECK_INTERVAL,
+    ):
+        self.dsns = dsns
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._checked: dict[str, tuple[float, bool]] = {}
+
+    def _usable(self, dsn: str) -> Optional[bool]:
+        """Cached verdict for `dsn`, or None when it needs re-checking."""
+        with self._lock:
+            checked_at, healthy = self._checked.get(dsn, (0.0, True))
+        if time.monotonic() - checked_at < self.check_interval:
+            return healthy
+        return None
+
+    def _mark(self, dsn: str, healthy: bool):
+        with self._lock:
+            self._checked[dsn] = (time.monotonic(), healthy)
+
+    def _connect_replica(self, dsn: str):
+        verdict = self._usable(dsn)
+        if verdict is False:
+            return None
+        try:
+            conn = psycopg2.connect(dsn)
+        except psycopg2.OperationalError as e:
+            logging.warning(f"Replica unavailable, skipping: {e}")
+            self._mark(dsn, False)
+            return None
+        if verdict is None:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(REPLICA_LAG_SQL)
+                    lag = float(cur.fetchone()[0])
+                conn.rollback()
+            except psycopg2.Error as e:
+                logging.warning(f"Replica lag check failed, skipping: {e}")
+                conn.close()
+                self._mark(dsn, False)
+                return None
+            healthy = lag <= self.max_lag
+            self._mark(dsn, healthy)
+            if not healthy:
+                logging.warning(f"Replica lagging {lag:.1f}s, skipping")
+                conn.close()
+                return None
+        return conn
+
+    def get_conn(self):
+        for _ in range(len(self.dsns)):
+            dsn = self.dsns[next(self._counter) % len(self.dsns)]
+            conn = self._connect_replica(dsn)
+            if conn is not None:
+                conn.set_session(readonly=True)
+                return conn
+        conn = get_conn()
+        conn.set_session(readonly=True)
+        return conn
+
+
+_router = ReplicaRouter(REPLICA_DSNS)
+
 
+def get_read_conn():
+    """Read-only connection for reporting queries.
 
-def init_db():
-    ddl = """
-    CREATE TABLE IF NOT EXISTS users (
-      id SERIAL PRIMARY KEY,
-      spotify_user_id TEXT UNIQUE NOT NULL,
-      email TEXT,
-      display_name TEXT,
-      access_token TEXT,
-      refresh_token TEXT
-    );
-
-    CREATE TABLE IF NOT EXISTS artists (
-      id TEXT NOT NULL,                -- Spotify artist id
-      user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-      name TEXT NOT NULL,
-      image_url TEXT,
-      count INT DEFAULT 0,
-      PRIMARY KEY (id, user_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS tracks (
-      id TEXT NOT NULL,                -- Spotify track id
-      user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-      name TEXT NOT NULL,
-      artist_id TEXT NOT NULL,         -- links to Spotify artist id
-      album_image TEXT,
-      count INT DEFAULT 0,
-      PRIMARY KEY (id, user_id),
-      FOREIGN KEY (artist_id, user_id) REFERENCES artists(id, user_id)
-    );
-    
-    CREATE TABLE IF NOT EXISTS plays (
-      id SERIAL PRIMARY KEY,
-      user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-      track_id TEXT NOT NULL,
-      played_at TIMESTAMP NOT NULL
-    );
-    CREATE INDEX IF NOT EXISTS idx_plays_user_week ON plays (user_id, played_at);
+    Goes to a replica when DB_REPLICA_DSNS is set and one is healthy, else to
+    the primary. Never write through it.
     """
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute(ddl)
-        conn.commit()
+    return _router.get_conn()
+
+
+# Functions for pull_data.py
 
 
 def upsert_user(
@@ -84,7 +157,12 @@ def upsert_user(
                 ON CONFLICT (spotify_user_id) DO UPDATE
                 SET display_name = EXCLUDED.display_name,
                     email = EXCLUDED.email,
-                    refresh_token = EXCLUDED.refresh_token
+                    refresh_token = EXCLUDED.refresh_token,
+                    -- A fresh signup brings a fresh token
+                    active = TRUE,
+                    consecutive_failures = 0,
+                    last_error_class = NULL,
+                    next_attempt_at = NULL
                 RETURNING id
                 """,
                 (spotify_user_id, display_name, email, refresh_token),
@@ -100,47 +178,127 @@ def upsert_user(
             conn.close()
 
 
-def upsert_artist(conn, artist_id: str, name: str, user_id: str, artist_image_url: str):
+def get_known_artist_ids(conn, artist_ids) -> set[str]:
+    """Return the subset of `artist_ids` already in the catalog."""
+    artist_ids = list(set(artist_ids))
+    if not artist_ids:
+        return set()
+    with conn.cursor() as cur:
+        cur.execute("SELECT id FROM artists WHERE id = ANY(%s)", (artist_ids,))
+        return {row[0] for row in cur.fetchall()}
+
+
+def get_imaged_artist_ids(conn, artist_ids) -> set[str]:
+    """Return the subset of `artist_ids` stored with a non-empty image."""
+    artist_ids = list(set(artist_ids))
+    if not artist_ids:
+        return set()
     with conn.cursor() as cur:
         cur.execute(
+            "SELECT id FROM artists WHERE id = ANY(%s) AND image_url <> ''",
+            (artist_ids,),
+        )
+        return {row[0] for row in cur.fetchall()}
+
+
+def get_known_track_ids(conn, track_ids) -> set[str]:
+    """Return the subset of `track_ids` already in the catalog."""
+    track_ids = list(set(track_ids))
+    if not track_ids:
+        return set()
+    with conn.cursor() as cur:
+        cur.execute("SELECT id FROM tracks WHERE id = ANY(%s)", (track_ids,))
+        return {row[0] for row in cur.fetchall()}
+
+
+def upsert_artists(conn, rows: list[tuple]):
+    """Insert (id, name, image_url) rows, keeping existing artists.
+
+    An empty image_url means "not looked up"; it never replaces a stored
+    image, and a stored empty image is filled in once a row brings one.
+    """
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
             """
-            INSERT INTO artists (id, user_id, name, image_url)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (id, user_id) DO NOTHING
+            INSERT INTO artists (id, name, image_url) VALUES %s
+            ON CONFLICT (id) DO UPDATE
+            SET image_url = EXCLUDED.image_url
+            WHERE COALESCE(artists.image_url, '') = ''
+              AND EXCLUDED.image_url <> ''
             """,
-            (artist_id, user_id, name, artist_image_url),
+            rows,
         )
 
 
-def upsert_track(
-    conn,
-    track_id: str,
-    user_id: str,
-    name: str,
-    artist_id: str,
-    album_image_url: Optional[str],
-):
+def upsert_tracks(conn, rows: list[tuple]):
+    """Upsert (id, name, artist_id, album_image, duration_ms) rows.
+
+    Ids must be unique within `rows`.
+    """
+    if not rows:
+        return
     with conn.cursor() as cur:
-        cur.execute(
+        # Skip the write entirely when nothing changed so popular tracks
+        # don't churn a new row version on every listen.
+        execute_values(
+            cur,
             """
-            INSERT INTO tracks (id, user_id, name, artist_id, album_image)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (id, user_id) DO UPDATE
-            SET album_image = EXCLUDED.album_image
+            INSERT INTO tracks (id, name, artist_id, album_image, duration_ms)
+            VALUES %s
+            ON CONFLICT (id) DO UPDATE
+            SET album_image = EXCLUDED.album_image,
+                duration_ms = COALESCE(EXCLUDED.duration_ms, tracks.duration_ms)
+            WHERE tracks.album_image IS DISTINCT FROM EXCLUDED.album_image
+               OR (EXCLUDED.duration_ms IS NOT NULL
+                   AND tracks.duration_ms IS DISTINCT FROM EXCLUDED.duration_ms)
             """,
-            (track_id, user_id, name, artist_id, album_image_url),
+            rows,
         )
 
 
-def insert_play(conn, user_id: str, track_id: str, played_at):
+def insert_plays(conn, rows: list[tuple]) -> list[tuple]:
+    """Insert (user_id, track_id, played_at) rows, skipping duplicates.
+
+    Returns (user_id, played_at) for the plays that were actually inserted.
+    """
+    if not rows:
+        return []
     with conn.cursor() as cur:
-        cur.execute(
+        return execute_values(
+            cur,
             """
-            INSERT INTO plays (user_id, track_id, played_at)
-            VALUES (%s, %s, %s)
+            INSERT INTO plays (user_id, track_id, played_at) VALUES %s
             ON CONFLICT DO NOTHING
+            RETURNING user_id, played_at
             """,
-            (user_id, track_id, played_at),
+            rows,
+            page_size=1000,
+            fetch=True,
+        )
+
+
+def notify_plays_changed(conn, user_weeks):
+    """Queue a NOTIFY on PLAYS_CHANNEL for each (user_id, week_start).
+
+    Postgres delivers the notifications when the caller's transaction
+    commits, and drops them on rollback, so listeners never see a week
+    whose plays aren't visible yet. Duplicate pairs within one
+    transaction are delivered once.
+    """
+    user_weeks = set(user_weeks)
+    if not user_weeks:
+        return
+    user_ids, week_starts = zip(*user_weeks)
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT pg_notify(%s, json_build_object('user_id', u, 'week_start', w)::text)
+            FROM unnest(%s::int[], %s::date[]) AS t(u, w)
+            """,
+            (PLAYS_CHANNEL, list(user_ids), list(week_starts)),
         )
 
 
@@ -149,7 +307,7 @@ def get_all_users(conn=None) -> list[dict]:
     """Return a list of all users from the database."""
     close_conn = False
     if conn is None:
-        conn = get_conn()
+        conn = get_read_conn()
         close_conn = True
     try:
         with conn.cursor() as cur:
@@ -166,6 +324,75 @@ def get_all_users(conn=None) -> list[dict]:
             conn.close()
 
 
+def get_processable_users(conn=None) -> list[dict]:
+    """Return users worth polling: active, with a token, and not backed off."""
+    close_conn = False
+    if conn is None:
+        conn = get_conn()
+        close_conn = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT id, spotify_user_id, display_name, email, refresh_token
+                FROM users
+                WHERE active
+                  AND refresh_token IS NOT NULL
+                  AND (next_attempt_at IS NULL OR next_attempt_at <= now())
+                """
+            )
+            if cur.description is not None:
+                columns = [desc[0] for desc in cur.description]
+                return [dict(zip(columns, row)) for row in cur.fetchall()]
+            else:
+                return []
+    finally:
+        if close_conn:
+            conn.close()
+
+
+def record_user_successes(conn, user_ids):
+    """Clear failure state; only touches users that had failures."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE users
+            SET consecutive_failures = 0, last_error_class = NULL, next_attempt_at = NULL
+            WHERE id = ANY(%s) AND consecutive_failures > 0
+            """,
+            (user_ids,),
+        )
+
+
+def record_user_failure(
+    conn,
+    user_id: int,
+    error_class: str,
+    deactivate: bool,
+    backoff_base: timedelta,
+    backoff_max: timedelta,
+):
+    """Count a failed attempt and push the next one out exponentially."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE users
+            SET consecutive_failures = consecutive_failures + 1,
+                last_error_class = %s,
+                last_error_at = now(),
+                next_attempt_at = now() + LEAST(
+                    %s * power(2, LEAST(consecutive_failures, 30)), %s
+                ),
+                active = active AND NOT %s
+            WHERE id = %s
+            """,
+            (error_class, backoff_base, backoff_max, deactivate, user_id),
+        )
+
+
 def get_user_by_spotify_id(spotify_user_id: str, conn=None) -> Optional[dict]:
     """Get a specific user by their Spotify ID."""
     close_conn = False
@@ -186,3 +413,152 @@ def get_user_by_spotify_id(spotify_user_id: str, conn=None) -> Optional[dict]:
     finally:
         if close_conn:
             conn.close()
+
+
+def get_user_by_id(user_id: int, conn=None) -> Optional[dict]:
+    """Get a specific user by their internal DB id."""
+    close_conn = False
+    if conn is None:
+        conn = get_conn()
+        close_conn = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, spotify_user_id, display_name, email, refresh_token FROM users WHERE id = %s",
+                (user_id,),
+            )
+            result = cur.fetchone()
+            if result and cur.description:
+                columns = [desc[0] for desc in cur.description]
+                return dict(zip(columns, result))
+            return None
+    finally:
+        if close_conn:
+            conn.close()
+
+
+# Functions for scheduler.py
+def get_user_activity(conn, since) -> dict[int, dict]:
+    """Return play count since `since` and latest play time for every user."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT
+                u.id,
+                (SELECT COUNT(*) FROM plays p
+                 WHERE p.user_id = u.id AND p.played_at >= %s) AS recent_plays,
+                (SELECT MAX(p.played_at) FROM plays p
+                 WHERE p.user_id = u.id) AS last_played_at
+            FROM users u
+            """,
+            (since,),
+        )
+        return {
+            user_id: {"recent_plays": recent_plays, "last_played_at": last_played_at}
+            for user_id, recent_plays, last_played_at in cur.fetchall()
+        }
+
+
+def get_last_played_at(conn, user_id: int):
+    """Return the timestamp of the user's most recent ingested play."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT MAX(played_at) FROM plays WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+
+# Functions for history_import.py
+def get_import_checkpoints(conn, user_id: int) -> dict[str, int]:
+    """Return records already imported per export file for a user."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT source, records_done FROM history_imports WHERE user_id = %s",
+            (user_id,),
+        )
+        return dict(cur.fetchall())
+
+
+def save_import_checkpoint(conn, user_id: int, source: str, records_done: int):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO history_imports (user_id, source, records_done)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id, source) DO UPDATE
+            SET records_done = EXCLUDED.records_done,
+                updated_at = now()
+            """,
+            (user_id, source, records_done),
+        )
+
+
+def create_import_job(conn, job_id: str, user_id: int):
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO import_jobs (id, user_id, status) VALUES (%s, %s, 'queued')",
+            (job_id, user_id),
+        )
+    conn.commit()
+
+
+def update_import_job(
+    conn,
+    job_id: str,
+    status: str,
+    records_read: int = 0,
+    plays_loaded: int = 0,
+    error: Optional[str] = None,
+):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE import_jobs
+            SET status = %s, records_read = %s, plays_loaded = %s, error = %s,
+                updated_at = now()
+            WHERE id = %s
+            """,
+            (status, records_read, plays_loaded, error, job_id),
+        )
+    conn.commit()
+
+
+def fail_import_jobs(conn, job_ids: list[str], error: str):
+    """Mark unfinished jobs failed; finished ones are left alone."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE import_jobs
+            SET status = 'failed', error = %s, updated_at = now()
+            WHERE id = ANY(%s) AND status IN ('queued', 'running')
+            """,
+            (error, job_ids),
+        )
+    conn.commit()
+
+
+def get_import_job(job_id: str, conn=None) -> Optional[dict]:
+    """Read a job from the primary; clients poll it right after uploading."""
+    close_conn = False
+    if conn is None:
+        conn = get_conn()
+        close_conn = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT j.id, u.spotify_user_id, j.status, j.records_read,
+                       j.plays_loaded, j.error, j.created_at, j.updated_at
+                FROM import_jobs j
+                JOIN users u ON u.id = j.user_id
+                WHERE j.id = %s
+                """,
+                (job_id,),
+            )
+            result = cur.fetchone()
+            if result and cur.description:
+                columns = [desc[0] for desc in cur.description]
+                return dict(zip(columns, result))
+            return None
+    finally:
+        if close_conn:
+            conn.close()
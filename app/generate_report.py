@@ -1,9 +1,9 @@
-from .aggregator import load_weekly_data
+from .cache import load_weekly_data_cached
 from datetime import timedelta
 
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
 from datetime import date
+from functools import lru_cache
 import os
 
 
@@ -13,18 +13,29 @@ TEMPLATE_NAME = "weekly_report.html"
 # Place new function after TEMPLATE_NAME definition
 
 
+def report_week(year, week):
+    """Start, (exclusive) end and display date of an ISO week's report."""
+    week_start = date.fromisocalendar(year, week, 1)
+    week_end = week_start + timedelta(days=7)
+    # Use the last day of the ISO week as the "today" display for that report
+    return week_start, week_end, week_end - timedelta(days=1)
+
+
 def generate_user_weekly_report(
     user_id, year, week, top_n=5, template_name=TEMPLATE_NAME
 ):
     """
     Generate HTML report for a specific user and week.
+
+    Week data comes from the LISTEN/NOTIFY-invalidated cache in
+    app/cache.py, which only serves hits while a listener is running.
+    Listening-time stats are computed fresh for each report.
     """
-    # Calculate week start/end
-    week_start = date.fromisocalendar(year, week, 1)
-    week_end = week_start + timedelta(days=7)
-    data = load_weekly_data(user_id, week_start, week_end)
-    # Use the last day of the ISO week as the "today" display for that report
-    display_date = week_end - timedelta(days=1)
+    from .listening_stats import load_listening_stats  # NumPy only when rendering
+
+    week_start, week_end, display_date = report_week(year, week)
+    data = load_weekly_data_cached(user_id, week_start, week_end)
+    listening = load_listening_stats(user_id, week_start, week_end, today=display_date)
     return generate_html_report(
         data,
         top_n=top_n,
@@ -32,6 +43,7 @@ def generate_user_weekly_report(
         year=year,
         week=week,
         today=display_date,
+        listening=listening,
     )
 
 
@@ -43,16 +55,15 @@ def make_spotify_artist_url(artist_id):
     return f"https://open.spotify.com/artist/{artist_id}"
 
 
-def top_n_sorted(dict_values, n=5, key="count"):
-    """
-    Accepts an iterable of dict entries (values of tracks/artists)
-    and returns top n sorted by `key` descending.
-    """
-    return sorted(dict_values, key=lambda x: x.get(key, 0), reverse=True)[:n]
+@lru_cache(maxsize=None)
+def setup_jinja_env(template_dir=TEMPLATE_DIR):
+    """Set up Jinja2 environment with custom filters.
 
+    Cached per template dir so templates are compiled once per process
+    instead of once per report.
+    """
+    from jinja2 import Environment, FileSystemLoader, select_autoescape
 
-def setup_jinja_env(template_dir=TEMPLATE_DIR):
-    """Set up Jinja2 environment with custom filters."""
     env = Environment(
         loader=FileSystemLoader(template_dir),
         autoescape=select_autoescape(["html", "xml"]),
@@ -72,6 +83,7 @@ def generate_html_report(
     year: int | None = None,
     week: int | None = None,
     today: date | None = None,
+    listening: dict | None = None,
 ):
     # Allow callers to override the reporting period, else default to current week
     if today is None:
@@ -87,25 +99,31 @@ def generate_html_report(
         year=year,
         week=week,
         today=today,
-        top_tracks=top_n_sorted(list(data["tracks"].values()), top_n),
-        top_artists=top_n_sorted(list(data["artists"].values()), top_n),
-        all_tracks=sorted(
-            data["tracks"].values(), key=lambda x: x["count"], reverse=True
-        ),
-        all_artists=sorted(
-            data["artists"].values(), key=lambda x: x["count"], reverse=True
-        ),
+        # load_weekly_data already ranked the rows; top N is a prefix
+        top_tracks=data["tracks"][:top_n],
+        top_artists=data["artists"][:top_n],
+        all_tracks=data["tracks"],
+        all_artists=data["artists"],
         has_tracks=bool(data["tracks"]),
         has_artists=bool(data["artists"]),
+        # listening_stats summary; the template skips the section without it
+        listening=listening,
     )
     return html
 
 
-def write_report_file(html, out_dir=OUTPUT_DIR):
-    today = date.today()
-    year, week, _ = today.isocalendar()
+def report_filename(year, week, user_id=None):
+    if user_id is None:
+        return f"weekly_report_{year}_w{week}.html"
+    return f"weekly_report_{year}_w{week}_user{user_id}.html"
+
+
+def write_report_file(html, out_dir=OUTPUT_DIR, year=None, week=None, user_id=None):
+    """Write one report; pass `user_id` so several users' reports can coexist."""
+    if year is None or week is None:
+        year, week, _ = date.today().isocalendar()
     os.makedirs(out_dir, exist_ok=True)
-    filename = f"weekly_report_{year}_w{week}.html"
+    filename = report_filename(year, week, user_id)
     path = os.path.join(out_dir, filename)
     with open(path, "w", encoding="utf-8") as f:
         f.write(html)
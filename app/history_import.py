@@ -0,0 +1,313 @@
+"""Bulk import of Spotify "Extended streaming history" exports.
+
+The export is a zip (or a folder) of `Streaming_History_Audio_*.json` files,
+each a single large JSON array. Files are parsed incrementally with ijson so
+memory stays flat regardless of export size. Plays are buffered in batches;
+each batch resolves unknown track/artist metadata with Spotify's bulk
+endpoints, is loaded through COPY into temp staging tables, and is merged
+into `plays`/`tracks`/`artists` in one transaction together with a
+checkpoint row. Re-running an interrupted import skips what was committed.
+"""
+
+import io
+import os
+import csv
+import time
+import glob
+import hashlib
+import logging
+import zipfile
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+import ijson
+
+from . import db
+from .aggregator import refresh_weekly_rollups
+from .pull_data import get_spotify_client
+
+BATCH_SIZE = 10_000
+SPOTIFY_BATCH_LIMIT = 50  # max ids per /tracks and /artists call
+MIN_MS_PLAYED = 30_000  # Spotify only counts a stream as a play after 30s
+EXPORT_PATTERNS = ("Streaming_History_Audio_", "endsong_")
+TRACK_URI_PREFIX = "spotify:track:"
+TOKEN_REFRESH_SECONDS = 45 * 60  # access tokens expire after an hour
+
+
+@dataclass
+class ImportProgress:
+    source: str = ""
+    records_read: int = 0
+    plays_loaded: int = 0
+    started: float = 0.0
+
+    @property
+    def records_per_second(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.records_read / elapsed if elapsed > 0 else 0.0
+
+
+def _is_history_file(name: str) -> bool:
+    base = os.path.basename(name)
+    return base.endswith(".json") and base.startswith(EXPORT_PATTERNS)
+
+
+def _file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()[:16]
+
+
+def iter_export_files(path: str) -> Iterator[tuple[str, io.BufferedIOBase]]:
+    """Yield (source key, binary file object) for each history file in `path`.
+
+    `path` may be the zip Spotify sends, an extracted folder, or one JSON file.
+    The key is the file name plus a fingerprint of its content (the zip
+    CRC-32 and size, or a SHA-256 of the file), so checkpoints from an older
+    export that reused the name don't apply to the new one.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in sorted(archive.infolist(), key=lambda info: info.filename):
+                if _is_history_file(info.filename):
+                    with archive.open(info) as f:
+                        yield f"{info.filename}#{info.CRC:08x}-{info.file_size}", f
+    elif os.path.isdir(path):
+        for name in sorted(glob.glob(os.path.join(path, "**", "*.json"), recursive=True)):
+            if _is_history_file(name):
+                with open(name, "rb") as f:
+                    yield f"{os.path.relpath(name, path)}#{_file_digest(name)}", f
+    else:
+        with open(path, "rb") as f:
+            yield f"{os.path.basename(path)}#{_file_digest(path)}", f
+
+
+def iter_plays(f) -> Iterator[Optional[tuple[str, str, int]]]:
+    """Stream (track_id, played_at, ms_played) tuples from one export file.
+
+    Yields None for records that are not countable track plays (podcasts,
+    skipped streams) so callers can still count every record for resuming.
+    """
+    for record in ijson.items(f, "item"):
+        uri = record.get("spotify_track_uri")
+        if (
+            not uri
+            or not uri.startswith(TRACK_URI_PREFIX)
+            or (record.get("ms_played") or 0) < MIN_MS_PLAYED
+        ):
+            yield None
+            continue
+        yield uri[len(TRACK_URI_PREFIX):], record["ts"], int(record["ms_played"])
+
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def resolve_metadata(conn, sp, track_ids) -> tuple[list[tuple], list[tuple]]:
+    """Fetch catalog rows for tracks (and their artists) not yet stored.
+
+    Returns (artist_rows, track_rows) ready for COPY.
+    """
+    unknown_tracks = sorted(set(track_ids) - db.get_known_track_ids(conn, track_ids))
+    track_rows = []
+    artist_names = {}
+    for chunk in _chunks(unknown_tracks, SPOTIFY_BATCH_LIMIT):
+        response = sp.tracks(chunk)
+        for track in response.get("tracks") or []:
+            if not track or not track.get("artists"):
+                continue
+            artist = track["artists"][0]
+            images = track["album"]["images"]
+            track_rows.append(
+                (
+                    track["id"],
+                    track["name"],
+                    artist["id"],
+                    images[0]["url"] if images else None,
+                    track.get("duration_ms"),
+                )
+            )
+            artist_names[artist["id"]] = artist["name"]
+
+    unknown_artists = sorted(
+        set(artist_names) - db.get_known_artist_ids(conn, artist_names)
+    )
+    artist_rows = {}
+    for chunk in _chunks(unknown_artists, SPOTIFY_BATCH_LIMIT):
+        response = sp.artists(chunk)
+        for artist in response.get("artists") or []:
+            if not artist:
+                continue
+            images = artist.get("images")
+            artist_rows[artist["id"]] = (
+                artist["id"],
+                artist["name"],
+                images[0]["url"] if images else "",
+            )
+    # /artists returns null for some ids; the track already named them, so
+    # store them without an image rather than break the tracks FK
+    for artist_id in unknown_artists:
+        artist_rows.setdefault(artist_id, (artist_id, artist_names[artist_id], ""))
+    return list(artist_rows.values()), track_rows
+
+
+def _copy_rows(cur, table: str, columns: tuple[str, ...], rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf
+    )
+
+
+def load_batch(conn, user_id: int, source: str, records_done: int, plays, artists, tracks) -> int:
+    """COPY one batch into staging and merge it, checkpointing atomically."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TEMP TABLE IF NOT EXISTS import_artists
+              (id TEXT, name TEXT, image_url TEXT) ON COMMIT DELETE ROWS;
+            CREATE TEMP TABLE IF NOT EXISTS import_tracks
+              (id TEXT, name TEXT, artist_id TEXT, album_image TEXT, duration_ms INT)
+              ON COMMIT DELETE ROWS;
+            CREATE TEMP TABLE IF NOT EXISTS import_plays
+              (track_id TEXT, played_at TIMESTAMP, ms_played INT) ON COMMIT DELETE ROWS;
+            """
+        )
+        _copy_rows(cur, "import_artists", ("id", "name", "image_url"), artists)
+        _copy_rows(
+            cur,
+            "import_tracks",
+            ("id", "name", "artist_id", "album_image", "duration_ms"),
+            tracks,
+        )
+        _copy_rows(cur, "import_plays", ("track_id", "played_at", "ms_played"), plays)
+        cur.execute(
+            """
+            INSERT INTO artists (id, name, image_url)
+            SELECT DISTINCT ON (id) id, name, image_url FROM import_artists
+            ON CONFLICT (id) DO NOTHING;
+
+            INSERT INTO tracks (id, name, artist_id, album_image, duration_ms)
+            SELECT DISTINCT ON (id) id, name, artist_id, album_image, duration_ms
+            FROM import_tracks
+            ON CONFLICT (id) DO NOTHING;
+            """
+        )
+        # Plays whose track could not be resolved have nothing to join to.
+        # Plays the ETL already stored only gain their ms_played (DO UPDATE
+        # needs each key once, hence DISTINCT ON); xmax = 0 tells freshly
+        # inserted rows from those updates.
+        cur.execute(
+            """
+            WITH merged AS (
+              INSERT INTO plays (user_id, track_id, played_at, ms_played)
+              SELECT DISTINCT ON (ip.played_at, ip.track_id)
+                %s, ip.track_id, ip.played_at, ip.ms_played
+              FROM import_plays ip
+              JOIN tracks t ON t.id = ip.track_id
+              ON CONFLICT (user_id, played_at, track_id) DO UPDATE
+                SET ms_played = EXCLUDED.ms_played
+                WHERE plays.ms_played IS NULL
+              RETURNING played_at, xmax = 0 AS inserted
+            )
+            SELECT date_trunc('week', played_at)::date, COUNT(*)
+            FROM merged
+            WHERE inserted
+            GROUP BY 1
+            """,
+            (user_id,),
+        )
+        weeks = cur.fetchall()
+        inserted = sum(count for _, count in weeks)
+        db.notify_plays_changed(conn, ((user_id, week) for week, _ in weeks))
+        db.save_import_checkpoint(conn, user_id, source, records_done)
+    conn.commit()
+    return inserted
+
+
+class _RefreshingClient:
+    """Spotify client that re-authenticates before its access token expires.
+
+    A large export takes longer than the one-hour token lifetime.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._sp = None
+        self._expires = 0.0
+
+    def get(self):
+        if self._sp is None or time.monotonic() >= self._expires:
+            self._sp = get_spotify_client(user=self.user)
+            self._expires = time.monotonic() + TOKEN_REFRESH_SECONDS
+        return self._sp
+
+
+def import_history(
+    spotify_user_id: str,
+    path: str,
+    batch_size: int = BATCH_SIZE,
+    on_progress: Optional[Callable[[ImportProgress], None]] = None,
+) -> ImportProgress:
+    """Import every history file under `path` for the given user."""
+    conn = db.get_conn()
+    progress = ImportProgress(started=time.monotonic())
+    try:
+        user = db.get_user_by_spotify_id(spotify_user_id, conn=conn)
+        if user is None:
+            raise ValueError(f"User with Spotify ID {spotify_user_id} not found")
+        client = _RefreshingClient(user)
+        checkpoints = db.get_import_checkpoints(conn, user["id"])
+
+        for source, f in iter_export_files(path):
+            progress.source = source
+            skip = checkpoints.get(source, 0)
+            if skip:
+                logging.info(f"Resuming {source} after {skip} records")
+
+            records = 0
+            batch: list[tuple[str, str, int]] = []
+            for play in iter_plays(f):
+                records += 1
+                if records <= skip:
+                    continue
+                progress.records_read += 1
+                if play is not None:
+                    batch.append(play)
+                if len(batch) >= batch_size:
+                    _flush(conn, client.get(), user["id"], source, records, batch, progress)
+                    batch = []
+                    if on_progress:
+                        on_progress(progress)
+            if records > skip:
+                _flush(conn, client.get(), user["id"], source, records, batch, progress)
+                if on_progress:
+                    on_progress(progress)
+
+        # History can touch any week, so rebuild all of this user's rollups
+        refresh_weekly_rollups(conn, user_ids=[user["id"]])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    logging.info(
+        f"Imported {progress.plays_loaded} plays from {progress.records_read} records "
+        f"({progress.records_per_second:.0f} records/s)"
+    )
+    return progress
+
+
+def _flush(conn, sp, user_id, source, records_done, batch, progress: ImportProgress):
+    artists, tracks = resolve_metadata(conn, sp, [play[0] for play in batch])
+    progress.plays_loaded += load_batch(
+        conn, user_id, source, records_done, batch, artists, tracks
+    )
+    logging.info(
+        f"{source}: {records_done} records, {progress.plays_loaded} plays loaded "
+        f"({progress.records_per_second:.0f} records/s)"
+    )
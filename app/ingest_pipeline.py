@@ -0,0 +1,291 @@
+"""Producer/consumer ingestion: Spotify fetchers feed a single DB writer.
+
+Fetcher threads call Spotify for one user at a time and put the
+normalized `PlayBatch` (or a `UserFailure`) on a bounded queue. One
+writer thread drains the queue and commits many users' batches per
+transaction with bulk statements. Network waits and DB round trips
+overlap instead of adding up. When the writer falls behind, the full
+queue blocks the fetchers (backpressure), so memory stays bounded.
+
+`AsyncIngestPipeline` swaps the fetcher threads for asyncio tasks so
+hundreds of users can be fetched concurrently from one process.
+"""
+
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from . import db
+from .pull_data import (
+    PlayBatch,
+    UserFailure,
+    failure_for,
+    fetch_user_batch,
+    write_play_batches,
+    write_user_failures,
+)
+
+FETCHERS = int(os.getenv("ETL_FETCHERS", 8))
+QUEUE_SIZE = int(os.getenv("ETL_QUEUE_SIZE", 64))
+COMMIT_PLAYS = 5000  # flush once this many plays are pending
+COMMIT_INTERVAL = 5.0  # ...or once the oldest pending batch is this old (s)
+
+_DONE = object()
+
+
+@dataclass
+class PipelineStats:
+    users_fetched: int = 0
+    users_failed: int = 0
+    plays_written: int = 0
+    commits: int = 0
+
+
+class IngestPipeline:
+    def __init__(
+        self,
+        fetchers: int = FETCHERS,
+        queue_size: int = QUEUE_SIZE,
+        commit_plays: int = COMMIT_PLAYS,
+        commit_interval: float = COMMIT_INTERVAL,
+    ):
+        self.fetchers = fetchers
+        self.commit_plays = commit_plays
+        self.commit_interval = commit_interval
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.stats = PipelineStats()
+        self.writer_error: BaseException | None = None
+        self._stats_lock = threading.Lock()
+        # Artists seen with an image during this run; others are asked of the DB
+        self._known_artists: set[str] = set()
+        self._lookup_conn = None
+        self._lookup_lock = threading.Lock()
+
+    def _is_known(self, artist_ids: set) -> set:
+        """Which of `artist_ids` already have an image, so need no lookup."""
+        known = artist_ids & self._known_artists
+        if artist_ids - known:
+            with self._lookup_lock:
+                found = db.get_imaged_artist_ids(self._lookup_conn, artist_ids - known)
+            self._known_artists.update(found)
+            known |= found
+        return known
+
+    def _open_lookup_conn(self):
+        self._lookup_conn = db.get_read_conn()
+        self._lookup_conn.autocommit = True
+
+    def _close_lookup_conn(self):
+        if self._lookup_conn is not None:
+            self._lookup_conn.close()
+            self._lookup_conn = None
+
+    def _put(self, item):
+        """Block while the queue is full, but give up if the writer died."""
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _fetch(self, user):
+        if self.stop_event.is_set():
+            return
+        try:
+            batch = fetch_user_batch(user, self._is_known)
+        except Exception as e:
+            logging.error(
+                f"Error processing user {user.get('spotify_user_id', 'unknown')}: {e}"
+            )
+            with self._stats_lock:
+                self.stats.users_failed += 1
+            failure = failure_for(user, e)
+            if failure is not None:
+                self._put(failure)
+            return
+        with self._stats_lock:
+            self.stats.users_fetched += 1
+        if batch is None:
+            # Nothing new, but the user's token worked: still clears failures
+            batch = PlayBatch(user_id=user["id"])
+        # Later fetchers can skip image lookups for artists this one just
+        # found. Their batches still carry the artist rows, so none of them
+        # depends on this batch being committed first.
+        self._known_artists.update(row[0] for row in batch.artists if row[2])
+        self._put(batch)
+
+    def _write_batches(self, conn, batches: list[PlayBatch]) -> int:
+        """Write `batches` in bulk, falling back to one user at a time.
+
+        Each attempt runs under a savepoint, so a batch the DB rejects only
+        loses that user's plays instead of the whole flush (and the writer).
+        """
+        with conn.cursor() as cur:
+            cur.execute("SAVEPOINT flush")
+            try:
+                written = write_play_batches(conn, batches)
+                cur.execute("RELEASE SAVEPOINT flush")
+                return written
+            except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT flush")
+                logging.warning(f"Bulk write failed, retrying user by user: {e}")
+
+            written = 0
+            for batch in batches:
+                cur.execute("SAVEPOINT user_batch")
+                try:
+                    written += write_play_batches(conn, [batch])
+                    cur.execute("RELEASE SAVEPOINT user_batch")
+                except Exception as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT user_batch")
+                    logging.error(f"Dropping plays for user {batch.user_id}: {e}")
+                    with self._stats_lock:
+                        self.stats.users_failed += 1
+            return written
+
+    def _flush(self, conn, pending: list):
+        batches = [item for item in pending if isinstance(item, PlayBatch)]
+        failures = [item for item in pending if isinstance(item, UserFailure)]
+        written = self._write_batches(conn, batches)
+        write_user_failures(conn, failures)
+        conn.commit()
+        self.stats.plays_written += written
+        self.stats.commits += 1
+        logging.info(f"Committed {written} plays for {len(pending)} users")
+
+    def _write(self):
+        conn = db.get_conn()
+        pending: list[PlayBatch | UserFailure] = []
+        pending_plays = 0
+        oldest = None
+        try:
+            while True:
+                timeout = None
+                if oldest is not None:
+                    timeout = max(self.commit_interval - (time.monotonic() - oldest), 0)
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if item is not None and item is not _DONE:
+                    pending.append(item)
+                    pending_plays += len(getattr(item, "plays", ()))
+                    oldest = oldest or time.monotonic()
+
+                due = oldest is not None and (
+                    time.monotonic() - oldest >= self.commit_interval
+                )
+                if pending and (item is _DONE or pending_plays >= self.commit_plays or due):
+                    self._flush(conn, pending)
+                    pending, pending_plays, oldest = [], 0, None
+                if item is _DONE:
+                    return
+        except BaseException as e:
+            conn.rollback()
+            self.writer_error = e
+            self.stop_event.set()
+            logging.error(f"Writer failed, stopping ingestion: {e}")
+        finally:
+            conn.close()
+
+    def run(self, users) -> PipelineStats:
+        """Ingest `users` and return once everything fetched is committed."""
+        self._open_lookup_conn()
+        writer = threading.Thread(target=self._write, name="ingest-writer")
+        writer.start()
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.fetchers, thread_name_prefix="ingest-fetch"
+            ) as pool:
+                list(pool.map(self._fetch, users))
+        finally:
+            # Always let the writer commit what it has and exit
+            self._put(_DONE)
+            writer.join()
+            self._close_lookup_conn()
+
+        if self.writer_error is not None:
+            raise self.writer_error
+        logging.info(f"Ingestion finished: {self.stats}")
+        return self.stats
+
+
+ASYNC_FETCHERS = int(os.getenv("ETL_ASYNC_FETCHERS", 200))
+
+
+class AsyncIngestPipeline(IngestPipeline):
+    """`IngestPipeline` with asyncio fetchers instead of a thread pool.
+
+    Up to `fetchers` users are in flight at once on a single event loop and
+    a shared keep-alive connection pool (see app/async_spotify.py); the DB
+    writer thread is the same one the threaded pipeline uses.
+    """
+
+    def __init__(self, fetchers: int = ASYNC_FETCHERS, **kwargs):
+        super().__init__(fetchers=fetchers, **kwargs)
+
+    async def _put_async(self, item):
+        """Like `_put`, but yields to the event loop while the queue is full."""
+        delay = 0.01
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+
+    async def _fetch_async(self, sp, user, slots: asyncio.Semaphore):
+        from . import async_spotify
+
+        async with slots:
+            if self.stop_event.is_set():
+                return
+            try:
+                batch = await async_spotify.fetch_user_batch(sp, user, self._is_known)
+            except Exception as e:
+                logging.error(
+                    f"Error processing user {user.get('spotify_user_id', 'unknown')}: {e}"
+                )
+                self.stats.users_failed += 1
+                failure = async_spotify.failure_for(user, e)
+                if failure is not None:
+                    await self._put_async(failure)
+                return
+        self.stats.users_fetched += 1
+        if batch is None:
+            batch = PlayBatch(user_id=user["id"])
+        # Only saves image lookups; batches carry their own artist rows
+        self._known_artists.update(row[0] for row in batch.artists if row[2])
+        await self._put_async(batch)
+
+    async def run_async(self, users) -> PipelineStats:
+        """Ingest `users` and return once everything fetched is committed."""
+        from .async_spotify import AsyncSpotify
+
+        await asyncio.to_thread(self._open_lookup_conn)
+        writer = threading.Thread(target=self._write, name="ingest-writer")
+        writer.start()
+        slots = asyncio.Semaphore(self.fetchers)
+        try:
+            async with AsyncSpotify() as sp:
+                await asyncio.gather(
+                    *(self._fetch_async(sp, user, slots) for user in users)
+                )
+        finally:
+            await self._put_async(_DONE)
+            await asyncio.to_thread(writer.join)
+            self._close_lookup_conn()
+
+        if self.writer_error is not None:
+            raise self.writer_error
+        logging.info(f"Ingestion finished: {self.stats}")
+        return self.stats
@@ -0,0 +1,349 @@
+"""Versioned schema migrations.
+
+Each migration runs once, in order, in its own transaction, and is recorded
+in `schema_migrations`. Apply them with `python migrate.py` when deploying;
+batch jobs and the API only call `check_schema()` on startup, a single
+SELECT, instead of replaying DDL every run.
+
+Migrations are written to be idempotent (IF NOT EXISTS, guarded DO blocks)
+so databases created by the old init_db(), which has no
+`schema_migrations` table yet, can be brought under version control by
+running them all once.
+
+Never edit a migration that has shipped; add a new one.
+"""
+
+import logging
+from typing import Callable, Union
+
+from .db import get_conn
+
+# Arbitrary key so concurrent deploys don't apply migrations twice
+MIGRATION_LOCK_ID = 7_253_001
+
+
+def _collapse_per_user_catalog(cur):
+    """Collapse the old per-user `artists`/`tracks` rows into one row per id.
+
+    Older databases keyed both tables by (id, user_id), storing a copy of the
+    same metadata for every listener. Keeps the first row per id that has an
+    image. No-op on databases created in catalog form.
+    """
+    cur.execute(
+        """
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'artists' AND column_name = 'user_id'
+        """
+    )
+    if cur.fetchone() is not None:
+        cur.execute(
+            """
+            CREATE TABLE artists_catalog (
+              id TEXT PRIMARY KEY,
+              name TEXT NOT NULL,
+              image_url TEXT
+            );
+            INSERT INTO artists_catalog (id, name, image_url)
+            SELECT DISTINCT ON (id) id, name, image_url
+            FROM artists
+            ORDER BY id, (image_url IS NULL OR image_url = ''), user_id;
+
+            CREATE TABLE tracks_catalog (
+              id TEXT PRIMARY KEY,
+              name TEXT NOT NULL,
+              artist_id TEXT NOT NULL REFERENCES artists_catalog(id),
+              album_image TEXT
+            );
+            INSERT INTO tracks_catalog (id, name, artist_id, album_image)
+            SELECT DISTINCT ON (id) id, name, artist_id, album_image
+            FROM tracks
+            ORDER BY id, (album_image IS NULL), user_id;
+
+            DROP TABLE tracks;
+            DROP TABLE artists;
+            ALTER TABLE artists_catalog RENAME TO artists;
+            ALTER INDEX artists_catalog_pkey RENAME TO artists_pkey;
+            ALTER TABLE tracks_catalog RENAME TO tracks;
+            ALTER INDEX tracks_catalog_pkey RENAME TO tracks_pkey;
+            ALTER TABLE tracks
+              RENAME CONSTRAINT tracks_catalog_artist_id_fkey TO tracks_artist_id_fkey;
+            """
+        )
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS artists (
+          id TEXT PRIMARY KEY,             -- Spotify artist id, shared by all users
+          name TEXT NOT NULL,
+          image_url TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS tracks (
+          id TEXT PRIMARY KEY,             -- Spotify track id, shared by all users
+          name TEXT NOT NULL,
+          artist_id TEXT NOT NULL REFERENCES artists(id),
+          album_image TEXT
+        );
+        """
+    )
+
+
+def _truncate_play_times(cur):
+    """Store every play time at whole-second precision.
+
+    The ETL used to keep Spotify's milliseconds while history exports only
+    have seconds, so the same play could be stored once from each source.
+    Drops the extra copies (keeping a whole-second row, else the oldest)
+    and rebuilds the rollups of the users that had any.
+    """
+    cur.execute(
+        """
+        DELETE FROM plays a USING plays b
+        WHERE a.user_id = b.user_id
+          AND a.track_id = b.track_id
+          AND a.played_at <> date_trunc('second', a.played_at)
+          AND date_trunc('second', a.played_at) = date_trunc('second', b.played_at)
+          AND (b.played_at = date_trunc('second', b.played_at) OR b.id < a.id)
+        RETURNING a.user_id
+        """
+    )
+    user_ids = {row[0] for row in cur.fetchall()}
+    cur.execute(
+        """
+        UPDATE plays SET played_at = date_trunc('second', played_at)
+        WHERE played_at <> date_trunc('second', played_at)
+        """
+    )
+    if user_ids:
+        from .aggregator import refresh_weekly_rollups
+
+        refresh_weekly_rollups(cur.connection, user_ids=user_ids)
+
+
+Migration = tuple[int, str, Union[str, Callable]]
+
+MIGRATIONS: list[Migration] = [
+    (
+        1,
+        "users and plays",
+        """
+        CREATE TABLE IF NOT EXISTS users (
+          id SERIAL PRIMARY KEY,
+          spotify_user_id TEXT UNIQUE NOT NULL,
+          email TEXT,
+          display_name TEXT,
+          access_token TEXT,
+          refresh_token TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS plays (
+          id SERIAL PRIMARY KEY,
+          user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          track_id TEXT NOT NULL,
+          played_at TIMESTAMP NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_plays_user_week ON plays (user_id, played_at);
+        """,
+    ),
+    (2, "shared artist/track catalog", _collapse_per_user_catalog),
+    (
+        3,
+        "unique plays",
+        """
+        -- Overlapping ETL runs and history imports re-send the same plays;
+        -- drop existing duplicates once, then let ON CONFLICT skip them.
+        DO $$
+        BEGIN
+          IF to_regclass('uq_plays_user_time_track') IS NULL THEN
+            DELETE FROM plays a USING plays b
+            WHERE a.user_id = b.user_id
+              AND a.played_at = b.played_at
+              AND a.track_id = b.track_id
+              AND a.id > b.id;
+          END IF;
+        END $$;
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_plays_user_time_track
+          ON plays (user_id, played_at, track_id);
+        """,
+    ),
+    (
+        4,
+        "history import checkpoints and jobs",
+        """
+        CREATE TABLE IF NOT EXISTS history_imports (
+          user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          source TEXT NOT NULL,            -- file name inside the export
+          records_done BIGINT NOT NULL DEFAULT 0,
+          updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+          PRIMARY KEY (user_id, source)
+        );
+
+        CREATE TABLE IF NOT EXISTS import_jobs (
+          id TEXT PRIMARY KEY,
+          user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          status TEXT NOT NULL,            -- queued | running | done | failed
+          records_read BIGINT NOT NULL DEFAULT 0,
+          plays_loaded BIGINT NOT NULL DEFAULT 0,
+          error TEXT,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+          updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+    ),
+    (
+        5,
+        "weekly rollups",
+        """
+        -- Per-week play counts maintained by aggregator.refresh_weekly_rollups;
+        -- multi-week recaps merge these instead of scanning raw plays.
+        CREATE TABLE IF NOT EXISTS weekly_track_counts (
+          user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          week_start DATE NOT NULL,
+          track_id TEXT NOT NULL,
+          plays INT NOT NULL,
+          PRIMARY KEY (user_id, week_start, track_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS weekly_artist_counts (
+          user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          week_start DATE NOT NULL,
+          artist_id TEXT NOT NULL,
+          plays INT NOT NULL,
+          PRIMARY KEY (user_id, week_start, artist_id)
+        );
+        """,
+    ),
+    (
+        6,
+        "track durations",
+        "ALTER TABLE tracks ADD COLUMN IF NOT EXISTS duration_ms INT;",
+    ),
+    (
+        7,
+        "user token health",
+        """
+        -- Users whose Spotify access keeps failing are backed off, and users
+        -- whose refresh token was revoked are deactivated.
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT TRUE;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS consecutive_failures INT NOT NULL DEFAULT 0;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS last_error_class TEXT;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS last_error_at TIMESTAMPTZ;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ;
+        """,
+    ),
+    (
+        8,
+        "covering indexes for weekly aggregation",
+        """
+        -- load_weekly_data filters plays on (user_id, played_at) and reads
+        -- track_id: uq_plays_user_time_track already covers that, so the
+        -- narrower index is dead weight on every insert.
+        DROP INDEX IF EXISTS idx_plays_user_week;
+
+        -- The joins read only these columns, so both lookups can be
+        -- index-only scans instead of heap fetches per track/artist.
+        CREATE INDEX IF NOT EXISTS idx_tracks_cover
+          ON tracks (id) INCLUDE (artist_id, name, album_image);
+        CREATE INDEX IF NOT EXISTS idx_artists_cover
+          ON artists (id) INCLUDE (name, image_url);
+        """,
+    ),
+    (
+        9,
+        "play durations",
+        """
+        -- How long a play actually lasted, where known (history imports);
+        -- listening stats fall back to the track length when it is NULL.
+        ALTER TABLE plays ADD COLUMN IF NOT EXISTS ms_played INT;
+        """,
+    ),
+    (10, "whole-second play times", _truncate_play_times),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+def _ensure_version_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+          version INT PRIMARY KEY,
+          name TEXT NOT NULL,
+          applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """
+    )
+
+
+def current_version(conn) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            return 0
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        return cur.fetchone()[0]
+
+
+def migrate(conn=None) -> list[int]:
+    """Apply every pending migration; returns the versions applied."""
+    close_conn = False
+    if conn is None:
+        conn = get_conn()
+        close_conn = True
+    applied = []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            _ensure_version_table(cur)
+            conn.commit()
+            try:
+                cur.execute("SELECT version FROM schema_migrations")
+                done = {row[0] for row in cur.fetchall()}
+                for version, name, step in MIGRATIONS:
+                    if version in done:
+                        continue
+                    logging.info(f"Applying migration {version}: {name}")
+                    if callable(step):
+                        step(cur)
+                    else:
+                        cur.execute(step)
+                    cur.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                        (version, name),
+                    )
+                    conn.commit()
+                    applied.append(version)
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                conn.commit()
+    finally:
+        if close_conn:
+            conn.close()
+    return applied
+
+
+def check_schema(conn=None):
+    """Cheap startup check that `python migrate.py` has been run."""
+    close_conn = False
+    if conn is None:
+        conn = get_conn()
+        close_conn = True
+    try:
+        version = current_version(conn)
+        conn.rollback()
+    finally:
+        if close_conn:
+            conn.close()
+    if version < LATEST_VERSION:
+        raise SchemaOutOfDate(
+            f"Database schema is at version {version}, code expects "
+            f"{LATEST_VERSION}. Run `python migrate.py`."
+        )
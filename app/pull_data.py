@@ -1,9 +1,23 @@
 import os
+import math
+import time
 import logging
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyOAuth
+import threading
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Optional
+from datetime import timedelta
 from dotenv import load_dotenv
 from . import db
+from .aggregator import get_week_range, lock_user_rollups, refresh_weekly_rollups
+from .migrations import check_schema
+
+if TYPE_CHECKING:
+    from spotipy import Spotify
+
+ARTIST_BATCH_LIMIT = 50  # max ids per /artists call
+IDLE_MARGIN_SECONDS = 30  # idle wait beyond a lease before a worker exits
+BACKOFF_BASE = timedelta(minutes=int(os.getenv("USER_BACKOFF_BASE_MINUTES", 60)))
+BACKOFF_MAX = timedelta(hours=int(os.getenv("USER_BACKOFF_MAX_HOURS", 168)))
 
 # Setup logging
 logging.basicConfig(
@@ -13,16 +27,6 @@ logging.basicConfig(
 )
 
 
-def get_current_user(sp) -> dict | None:
-    """Get the current user's information from Spotify."""
-    try:
-        user_info = sp.current_user()
-        return user_info
-    except Exception as e:
-        logging.error(f"Error fetching user info: {e}")
-        return None
-
-
 def user_exists(user_id, conn=None):
     """Check if a user exists in the database."""
     close_conn = False
@@ -73,22 +77,11 @@ def add_user(user_id, display_name, email, conn=None):
             conn.close()
 
 
-def get_artist_image_url(sp: Spotify, artist_id) -> str:
-    try:
-        artist_info = sp.artist(artist_id=artist_id)
-        artist_image_url = ""
-
-        if artist_info and artist_info.get("images"):
-            artist_image_url = artist_info["images"][0]["url"]
-
-        return artist_image_url
-    except Exception as e:
-        logging.error(f"Error fetching artist image: {e}")
-        return ""
-
-
 def get_spotify_client(user=None):
     """Initialize and return a Spotify client."""
+    from spotipy import Spotify
+    from spotipy.oauth2 import SpotifyOAuth
+
     load_dotenv()
 
     CLIENT_ID = os.getenv("CLIENT_ID")
@@ -117,118 +110,352 @@ def get_spotify_client(user=None):
     return Spotify(auth_manager=sp_oauth)
 
 
+@dataclass
+class PlayBatch:
+    """Normalized rows for one user's poll, ready to be written in bulk."""
+
+    user_id: int
+    # Every artist the plays reference, so the tracks FK never depends on
+    # another batch; artists skipped by the image lookup have image_url ""
+    artists: list[tuple] = field(default_factory=list)
+    tracks: list[tuple] = field(default_factory=list)
+    plays: list[tuple] = field(default_factory=list)
+    artist_calls: int = 0  # /artists requests made for this batch
+
+
+@dataclass
+class UserFailure:
+    """A user whose Spotify access failed; recorded in the users table."""
+
+    user_id: int
+    error_class: str
+    permanent: bool
+
+
+def failure_for(user, exc: Exception) -> Optional[UserFailure]:
+    """Classify `exc` as a per-user Spotify failure, or None if it isn't one.
+
+    A refresh token Spotify rejects with invalid_grant has been revoked or
+    has expired and will never work again; anything else from Spotify is
+    treated as transient. Non-Spotify errors (DB, bugs) don't count against
+    the user.
+    """
+    from spotipy.exceptions import SpotifyException, SpotifyOauthError
+
+    if isinstance(exc, SpotifyOauthError):
+        permanent = getattr(exc, "error", None) == "invalid_grant"
+    elif isinstance(exc, SpotifyException):
+        permanent = False
+    else:
+        return None
+    return UserFailure(user["id"], type(exc).__name__, permanent)
+
+
+def write_user_failures(conn, failures: list[UserFailure]):
+    for failure in failures:
+        if failure.permanent:
+            logging.warning(
+                f"Deactivating user {failure.user_id}: refresh token rejected"
+            )
+        db.record_user_failure(
+            conn,
+            failure.user_id,
+            failure.error_class,
+            deactivate=failure.permanent,
+            backoff_base=BACKOFF_BASE,
+            backoff_max=BACKOFF_MAX,
+        )
+
+
+def record_failure(conn, user, exc: Exception) -> Optional[UserFailure]:
+    """Record a failed attempt for `user` in its own transaction.
+
+    Returns the recorded failure, or None if `exc` wasn't the user's fault.
+    """
+    failure = failure_for(user, exc)
+    if failure is None:
+        return None
+    write_user_failures(conn, [failure])
+    conn.commit()
+    return failure
+
+
+def artist_images(artists) -> dict[str, str]:
+    """Map artist id -> first image URL from an /artists response."""
+    images = {}
+    for artist in artists or []:
+        if artist and artist.get("images"):
+            images[artist["id"]] = artist["images"][0]["url"]
+    return images
+
+
+def get_artist_image_urls(sp: "Spotify", artist_ids) -> dict[str, str]:
+    """Look up artist images 50 at a time; missing images map to ""."""
+    artist_ids = list(artist_ids)
+    images = {}
+    for i in range(0, len(artist_ids), ARTIST_BATCH_LIMIT):
+        try:
+            response = sp.artists(artist_ids[i : i + ARTIST_BATCH_LIMIT])
+        except Exception as e:
+            logging.error(f"Error fetching artist images: {e}")
+            continue
+        images.update(artist_images(response.get("artists")))
+    return images
+
+
+def batch_from_recent(user, items) -> tuple[PlayBatch, dict[str, str]]:
+    """Normalize recently-played `items` into a batch (without artists).
+
+    Also returns artist id -> name for every artist seen, so the caller
+    can look up images for the ones not in the catalog yet. Local files
+    (no Spotify track or artist id) are skipped.
+    """
+    batch = PlayBatch(user_id=user["id"])
+    artist_names = {}
+    for item in items:
+        track = item.get("track")
+        if not track or track.get("is_local") or not track.get("id"):
+            continue
+        artist = (track.get("artists") or [{}])[0]
+        if not artist.get("id"):
+            continue
+        artist_names[artist["id"]] = artist["name"]
+        album_images = track["album"]["images"]
+        batch.tracks.append(
+            (
+                track["id"],
+                track["name"],
+                artist["id"],
+                album_images[0]["url"] if album_images else None,
+                track.get("duration_ms"),
+            )
+        )
+        # Whole seconds, like history exports, so both sources dedupe
+        batch.plays.append((user["id"], track["id"], item["played_at"][:19]))
+    return batch, artist_names
+
+
+def fetch_user_batch(
+    user, known_artist_ids: Callable[[set], set], after: int | None = None
+) -> Optional[PlayBatch]:
+    """Pull recent plays for a user from Spotify without touching the DB.
+
+    `known_artist_ids` returns which of the given artist ids already have
+    an image in the catalog; only the others get an image lookup. `after` is a unix
+    timestamp in milliseconds. Returns None when Spotify had no new plays;
+    a failed profile call raises, so it counts against the user's token.
+    """
+    sp = get_spotify_client(user=user)
+    user_profile = sp.current_user()
+    if not user_profile or not user_profile.get("id"):
+        raise ValueError(
+            f"Could not fetch user profile from Spotify for user {user.get('spotify_user_id', 'unknown')}."
+        )
+
+    # Fetch recent plays
+    recent = sp.current_user_recently_played(limit=50, after=after)
+    if not recent or not recent.get("items"):
+        logging.info(f"No recent plays found for user {user['spotify_user_id']}.")
+        return None
+
+    batch, artist_names = batch_from_recent(user, recent["items"])
+
+    # Artist metadata lives in the shared catalog, so only look up images
+    # for artists it has none for yet.
+    new_artists = set(artist_names) - known_artist_ids(set(artist_names))
+    images = get_artist_image_urls(sp, new_artists)
+    batch.artist_calls = math.ceil(len(new_artists) / ARTIST_BATCH_LIMIT)
+    batch.artists = [
+        (artist_id, name, images.get(artist_id, ""))
+        for artist_id, name in artist_names.items()
+    ]
+    return batch
+
+
+def write_play_batches(conn, batches: list[PlayBatch]) -> int:
+    """Write several users' batches with one round of bulk statements.
+
+    Also refreshes the weekly rollups the new plays touched and notifies
+    report caches of the changed weeks. The caller owns the transaction.
+    Returns the number of plays actually inserted.
+    """
+    artists = {}
+    tracks = {}
+    plays = []
+    for batch in batches:
+        for row in batch.artists:
+            # Keep the row that has an image when batches disagree
+            if row[2] or row[0] not in artists:
+                artists[row[0]] = row
+        tracks.update((row[0], row) for row in batch.tracks)
+        plays.extend(batch.plays)
+
+    db.upsert_artists(conn, list(artists.values()))
+    db.upsert_tracks(conn, list(tracks.values()))
+    inserted = db.insert_plays(conn, plays)
+    db.record_user_successes(conn, (batch.user_id for batch in batches))
+    # Tell report caches which weeks gained plays; delivered on commit
+    db.notify_plays_changed(
+        conn,
+        (
+            (user_id, get_week_range(played_at.date())[0])
+            for user_id, played_at in inserted
+        ),
+    )
+
+    # Keep the weekly rollups used by multi-week recaps in step with plays.
+    # Each user is rebuilt from the week of their earliest new play; users
+    # starting in the same week share one refresh.
+    earliest = {}
+    for user_id, played_at in inserted:
+        earliest[user_id] = min(played_at, earliest.get(user_id, played_at))
+    by_week = {}
+    for user_id, played_at in earliest.items():
+        by_week.setdefault(get_week_range(played_at.date())[0], set()).add(user_id)
+    lock_user_rollups(conn, earliest)
+    for week_start, user_ids in by_week.items():
+        refresh_weekly_rollups(conn, since=week_start, user_ids=user_ids)
+    return len(inserted)
+
+
+def process_user(conn, user, after: int | None = None) -> PlayBatch:
+    """Pull recent plays for a single user and stage them on `conn`.
+
+    `after` is a unix timestamp in milliseconds; only plays after it are
+    requested. Returns the batch Spotify's response became (empty when
+    there was nothing usable). The caller owns the transaction.
+    """
+    batch = fetch_user_batch(
+        user, lambda ids: db.get_imaged_artist_ids(conn, ids), after=after
+    )
+    if batch is None:
+        db.record_user_successes(conn, [user["id"]])
+        return PlayBatch(user_id=user["id"])
+    write_play_batches(conn, [batch])
+
+    logging.info(
+        f"Successfully updated plays for user {user['display_name']} ({user['spotify_user_id']})"
+    )
+    return batch
+
+
 def fetch_data():
-    conn = None
+    """Ingest every user through the fetcher/writer pipeline."""
+    from .ingest_pipeline import IngestPipeline
+
     try:
-        conn = db.get_conn()
-        users = db.get_all_users(conn=conn)
+        users = db.get_processable_users()
+        IngestPipeline().run(users)
+        logging.info("All data committed successfully")
+    except Exception as e:
+        logging.error(f"Error fetching Spotify data: {e}")
+        raise
 
-        # Get current Spotify user profile
-        for user in users:
-            try:
-                sp = get_spotify_client(user=user)
-                user_profile = get_current_user(sp)
-                if not user_profile or not user_profile.get("id"):
-                    logging.error(
-                        f"Could not fetch user profile from Spotify for user {user.get('spotify_user_id', 'unknown')}."
-                    )
-                    continue
-
-                # Fetch recent plays
-                recent = sp.current_user_recently_played()
-                if not recent or not recent.get("items"):
-                    logging.info(
-                        f"No recent plays found for user {user['spotify_user_id']}."
-                    )
-                    continue
-
-                # Process each recently played track
-                for item in recent["items"]:
-                    track = item["track"]
-                    artist = track["artists"][0]
-
-                    artist_id = artist["id"]
-                    artist_name = artist["name"]
-
-                    track_id = track["id"]
-                    track_name = track["name"]
-                    album_image_url = (
-                        track["album"]["images"][0]["url"]
-                        if track["album"]["images"]
-                        else None
-                    )
-
-                    try:
-                        # Upsert artist and track
-                        artist_image_url = get_artist_image_url(
-                            sp=sp, artist_id=artist_id
-                        )
-
-                        db.upsert_artist(
-                            conn,
-                            artist_id=artist_id,
-                            name=artist_name,
-                            user_id=user["id"],
-                            artist_image_url=artist_image_url,
-                        )
-                        db.upsert_track(
-                            conn,
-                            track_id=track_id,
-                            user_id=user["id"],
-                            name=track_name,
-                            artist_id=artist_id,
-                            album_image_url=album_image_url,
-                        )
-
-                        # Insert play
-                        played_at = item["played_at"]
-                        db.insert_play(
-                            conn,
-                            user_id=user["id"],
-                            track_id=track_id,
-                            played_at=played_at,
-                        )
-
-                    except Exception as e:
-                        logging.error(
-                            f"Error inserting data for track {track_name}: {e}"
-                        )
-
-                logging.info(
-                    f"Successfully updated plays for user {user['display_name']} ({user['spotify_user_id']})"
-                )
 
-            except Exception as e:
-                logging.error(
-                    f"Error processing user {user.get('spotify_user_id', 'unknown')}: {e}"
-                )
-                continue
+def fetch_data_async():
+    """Like `fetch_data`, but fetch users on one event loop (aiohttp).
 
-        # Commit all changes after processing all users
-        if conn:
-            conn.commit()
-            logging.info("All data committed successfully")
+    Keeps up to ETL_ASYNC_FETCHERS users in flight from this process.
+    """
+    import asyncio
+    from .ingest_pipeline import AsyncIngestPipeline
 
+    try:
+        users = db.get_processable_users()
+        asyncio.run(AsyncIngestPipeline().run_async(users))
+        logging.info("All data committed successfully")
     except Exception as e:
         logging.error(f"Error fetching Spotify data: {e}")
-        if conn:
-            conn.rollback()
         raise
-    finally:
-        # Close connection in finally block
-        if conn:
-            conn.close()
 
 
-def main():
+def enqueue_all_users(queue) -> int:
+    """Seed the shared work queue with every processable user for a new run."""
+    users = db.get_processable_users()
+    count = queue.enqueue(user["id"] for user in users)
+    logging.info(f"Enqueued {count} users for ingestion")
+    return count
+
+
+def _keep_lease_alive(queue, user_id, worker_id, stop: threading.Event):
+    """Heartbeat the lease on `user_id` until `stop` is set."""
+    interval = max(queue.lease_seconds / 3, 1)
+    while not stop.wait(interval):
+        if not queue.heartbeat(user_id, worker_id):
+            logging.warning(f"Lost lease on user {user_id}")
+            return
+
+
+def run_worker(queue, worker_id: str, idle_timeout: Optional[float] = None):
+    """Claim users from `queue` and ingest them until the run is drained.
+
+    Each user is committed in its own transaction so a crash only loses the
+    user currently being processed; its lease then expires and another
+    worker retries it. An idle worker therefore keeps polling for at least
+    one full lease (plus a margin) before giving up on outstanding leases.
+    """
+    if idle_timeout is None:
+        idle_timeout = queue.lease_seconds + IDLE_MARGIN_SECONDS
+    conn = db.get_conn()
+    idle_since = None
+    processed = 0
     try:
-        logging.info("Initializing DB")
-        db.init_db()
-        logging.info("DB initialized")
-    except Exception as e:
-        logging.error(f"Error initializing DB: {e}")
+        while True:
+            user_id = queue.claim(worker_id)
+            if user_id is None:
+                if queue.is_drained():
+                    break
+                # Other workers still hold leases that may expire and come back
+                idle_since = idle_since or time.monotonic()
+                if time.monotonic() - idle_since > idle_timeout:
+                    break
+                time.sleep(1)
+                continue
+            idle_since = None
+
+            stop = threading.Event()
+            heartbeat = threading.Thread(
+                target=_keep_lease_alive,
+                args=(queue, user_id, worker_id, stop),
+                daemon=True,
+            )
+            heartbeat.start()
+            user = None
+            try:
+                user = db.get_user_by_id(user_id, conn=conn)
+                if user is not None:
+                    process_user(conn, user)
+                conn.commit()
+                queue.complete(user_id, worker_id)
+                processed += 1
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Error processing user {user_id}: {e}")
+                failure = record_failure(conn, user, e) if user else None
+                if failure is not None and failure.permanent:
+                    # A revoked token won't work on retry either
+                    queue.complete(user_id, worker_id)
+                else:
+                    queue.fail(user_id, worker_id)
+            finally:
+                stop.set()
+                heartbeat.join()
+    finally:
+        conn.close()
+
+    logging.info(f"Worker {worker_id} finished after {processed} users: {queue.stats()}")
+    return processed
+
 
-    fetch_data()
+def main(use_async: Optional[bool] = None):
+    # Schema changes are applied by `python migrate.py` at deploy time
+    check_schema()
+    if use_async is None:
+        use_async = os.getenv("ETL_ASYNC") == "1"
+    if use_async:
+        fetch_data_async()
+    else:
+        fetch_data()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,206 @@
+"""Multi-week recaps (year in review) built on the weekly rollups.
+
+Nothing here reads `plays`. Postgres sums the `weekly_track_counts` and
+`weekly_artist_counts` rows for the range, and the results are streamed
+per user from server-side cursors ordered by user id. Each user's top K is
+kept with a bounded heap, so memory depends on K, not on how many tracks a
+user played or how many users are in the batch.
+
+Ranges are whole ISO weeks: the start is moved back to its Monday and the
+(exclusive) end forward to the next Monday.
+"""
+
+import heapq
+from datetime import date, timedelta
+from itertools import groupby
+from operator import itemgetter
+from typing import Iterator, Optional
+
+from .db import get_read_conn
+
+TOP_K = 10
+FETCH_SIZE = 5000
+
+USERS_SQL = """
+SELECT id, display_name, email FROM users
+WHERE {user_filter}
+ORDER BY id
+"""
+
+TRACK_TOTALS_SQL = """
+SELECT c.user_id, t.id, t.name, a.name, a.id, t.album_image, SUM(c.plays)
+FROM weekly_track_counts c
+JOIN tracks t ON t.id = c.track_id
+JOIN artists a ON a.id = t.artist_id
+WHERE c.week_start >= %(start)s AND c.week_start < %(end)s AND {user_filter}
+GROUP BY c.user_id, t.id, a.id
+ORDER BY c.user_id
+"""
+
+ARTIST_TOTALS_SQL = """
+SELECT c.user_id, a.id, a.name, a.image_url, SUM(c.plays)
+FROM weekly_artist_counts c
+JOIN artists a ON a.id = c.artist_id
+WHERE c.week_start >= %(start)s AND c.week_start < %(end)s AND {user_filter}
+GROUP BY c.user_id, a.id
+ORDER BY c.user_id
+"""
+
+WEEKLY_TOTALS_SQL = """
+SELECT c.user_id, c.week_start, SUM(c.plays)
+FROM weekly_track_counts c
+WHERE c.week_start >= %(start)s AND c.week_start < %(end)s AND {user_filter}
+GROUP BY c.user_id, c.week_start
+ORDER BY c.user_id, c.week_start
+"""
+
+
+def year_range(year: int) -> tuple[date, date]:
+    """First Monday of ISO `year` and the first Monday of the next one."""
+    return date.fromisocalendar(year, 1, 1), date.fromisocalendar(year + 1, 1, 1)
+
+
+def align_to_weeks(start: date, end: date) -> tuple[date, date]:
+    start = start - timedelta(days=start.weekday())
+    end = end + timedelta(days=(7 - end.weekday()) % 7)
+    return start, end
+
+
+def week_streaks(active_weeks: list[date], range_end: date) -> tuple[int, int]:
+    """Return (longest, current) runs of consecutive active weeks.
+
+    `active_weeks` must be sorted. The current streak is the run ending in
+    the last week of the range, or 0 if that week had no plays.
+    """
+    longest = run = 0
+    previous = None
+    for week_start in active_weeks:
+        if previous is not None and week_start - previous == timedelta(days=7):
+            run += 1
+        else:
+            run = 1
+        longest = max(longest, run)
+        previous = week_start
+    last_week = range_end - timedelta(days=7)
+    current = run if previous == last_week else 0
+    return longest, current
+
+
+class _UserStream:
+    """Walk a user-ordered result set one user at a time, in step with others."""
+
+    def __init__(self, rows):
+        self._groups = groupby(rows, key=itemgetter(0))
+        self._current = next(self._groups, None)
+        self._handed_out = False
+
+    def take(self, user_id: int):
+        """Rows for `user_id`; valid until the next call. Ids must increase."""
+        if self._handed_out:
+            self._current = next(self._groups, None)
+            self._handed_out = False
+        # Users without rows in this stream simply get an empty group
+        while self._current is not None and self._current[0] < user_id:
+            self._current = next(self._groups, None)
+        if self._current is None or self._current[0] != user_id:
+            return iter(())
+        self._handed_out = True
+        return self._current[1]
+
+
+def _stream(conn, name: str, sql: str, params: dict, user_filter: str):
+    cur = conn.cursor(name=name)
+    cur.itersize = FETCH_SIZE
+    cur.execute(sql.format(user_filter=user_filter), params)
+    return cur
+
+
+def _top_k(rows, k: int) -> list:
+    # nlargest keeps a k-sized heap while consuming the stream
+    return heapq.nlargest(k, rows, key=itemgetter(-1))
+
+
+def _iter_recaps(
+    conn, start: date, end: date, top_k: int, user_id: Optional[int] = None
+) -> Iterator[dict]:
+    start, end = align_to_weeks(start, end)
+    params = {"start": start, "end": end, "user_id": user_id}
+    user_filter = "TRUE" if user_id is None else "c.user_id = %(user_id)s"
+
+    users = _stream(
+        conn,
+        "recap_users",
+        USERS_SQL,
+        params,
+        "TRUE" if user_id is None else "id = %(user_id)s",
+    )
+    tracks = _UserStream(
+        _stream(conn, "recap_tracks", TRACK_TOTALS_SQL, params, user_filter)
+    )
+    artists = _UserStream(
+        _stream(conn, "recap_artists", ARTIST_TOTALS_SQL, params, user_filter)
+    )
+    weeks = _UserStream(
+        _stream(conn, "recap_weeks", WEEKLY_TOTALS_SQL, params, user_filter)
+    )
+
+    for uid, display_name, email in users:
+        top_tracks = _top_k(tracks.take(uid), top_k)
+        top_artists = _top_k(artists.take(uid), top_k)
+        weekly = [(week_start, count) for _, week_start, count in weeks.take(uid)]
+        longest, current = week_streaks([w for w, count in weekly if count], end)
+        yield {
+            "user": {"id": uid, "display_name": display_name, "email": email},
+            "start": start,
+            "end": end,
+            "total_plays": sum(count for _, count in weekly),
+            "top_tracks": [
+                {
+                    "track_id": track_id,
+                    "name": name,
+                    "artist_name": artist_name,
+                    "artist_id": artist_id,
+                    "album_image": album_image,
+                    "count": count,
+                }
+                for _, track_id, name, artist_name, artist_id, album_image, count in top_tracks
+            ],
+            "top_artists": [
+                {
+                    "id": artist_id,
+                    "name": name,
+                    "artist_image": artist_image,
+                    "count": count,
+                }
+                for _, artist_id, name, artist_image, count in top_artists
+            ],
+            "weekly_totals": [
+                {"week_start": week_start, "count": count}
+                for week_start, count in weekly
+            ],
+            "active_weeks": sum(1 for _, count in weekly if count),
+            "longest_week_streak": longest,
+            "current_week_streak": current,
+        }
+
+
+def load_range_recap(
+    user_id: int, start: date, end: date, top_k: int = TOP_K
+) -> dict:
+    """Recap for one user between `start` and `end` (exclusive)."""
+    conn = get_read_conn()
+    try:
+        for recap in _iter_recaps(conn, start, end, top_k, user_id=user_id):
+            return recap
+        raise ValueError(f"User with ID {user_id} not found")
+    finally:
+        conn.close()
+
+
+def iter_range_recaps(start: date, end: date, top_k: int = TOP_K) -> Iterator[dict]:
+    """Yield a recap for every user in a single pass over the rollups."""
+    conn = get_read_conn()
+    try:
+        yield from _iter_recaps(conn, start, end, top_k)
+    finally:
+        conn.close()
@@ -0,0 +1,237 @@
+"""Activity-adaptive polling of Spotify's recently-played endpoint.
+
+The endpoint only returns a user's last 50 plays, so the right poll interval
+depends on how fast each user listens. The scheduler keeps a listening rate
+per user (seeded from ingested plays, then updated from every poll) and
+schedules the next poll for when the user is expected to have filled
+TARGET_FILL of the window. Idle users drift towards MAX_INTERVAL and users
+with no recent plays at all are only checked every DORMANT_INTERVAL.
+
+All polls share one token bucket so the daemon never exceeds
+API_CALLS_PER_HOUR, however many users are due at once.
+"""
+
+import os
+import heapq
+import signal
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass, field
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from . import db
+from .migrations import check_schema
+from .pull_data import process_user, record_failure
+
+load_dotenv()
+
+WINDOW_SIZE = 50  # plays returned by /me/player/recently-played
+TARGET_FILL = 0.6  # poll once this fraction of the window is expected to be used
+MIN_INTERVAL = timedelta(minutes=int(os.getenv("POLL_MIN_MINUTES", 10)))
+MAX_INTERVAL = timedelta(hours=int(os.getenv("POLL_MAX_HOURS", 6)))
+DORMANT_INTERVAL = timedelta(hours=int(os.getenv("POLL_DORMANT_HOURS", 24)))
+ACTIVITY_WINDOW = timedelta(days=7)
+RATE_SMOOTHING = 0.3  # weight of the newest observation in the EWMA
+API_CALLS_PER_HOUR = int(os.getenv("SPOTIFY_CALLS_PER_HOUR", 3600))
+USER_REFRESH_INTERVAL = timedelta(minutes=15)
+
+# Profile + recently-played, before the batched /artists lookups
+BASE_CALLS_PER_POLL = 2
+
+
+def _utcnow() -> datetime:
+    # plays.played_at is stored as naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@dataclass(order=True)
+class UserSchedule:
+    next_poll: datetime
+    user_id: int = field(compare=False)
+    plays_per_hour: float = field(default=0.0, compare=False)
+    last_played_at: Optional[datetime] = field(default=None, compare=False)
+    last_polled: Optional[datetime] = field(default=None, compare=False)
+
+    def is_dormant(self, now: datetime) -> bool:
+        return self.plays_per_hour == 0 and (
+            self.last_played_at is None
+            or now - self.last_played_at > ACTIVITY_WINDOW
+        )
+
+    def interval(self, now: datetime) -> timedelta:
+        if self.is_dormant(now):
+            return DORMANT_INTERVAL
+        if self.plays_per_hour <= 0:
+            return MAX_INTERVAL
+        hours = WINDOW_SIZE * TARGET_FILL / self.plays_per_hour
+        return min(max(timedelta(hours=hours), MIN_INTERVAL), MAX_INTERVAL)
+
+    def observe(self, plays: int, now: datetime):
+        """Fold the result of a poll into the rate estimate."""
+        if self.last_polled is not None:
+            elapsed = (now - self.last_polled).total_seconds() / 3600
+            if elapsed > 0:
+                observed = plays / elapsed
+                self.plays_per_hour = (
+                    RATE_SMOOTHING * observed
+                    + (1 - RATE_SMOOTHING) * self.plays_per_hour
+                )
+        self.last_polled = now
+        self.next_poll = now + self.interval(now)
+        if plays >= WINDOW_SIZE:
+            # The window overflowed, so plays were probably lost: come back sooner
+            self.next_poll = now + max(self.interval(now) / 2, MIN_INTERVAL)
+
+
+class TokenBucket:
+    """Refilling budget of Spotify API calls shared by every poll."""
+
+    def __init__(self, calls_per_hour: int = API_CALLS_PER_HOUR):
+        self.capacity = float(calls_per_hour)
+        self.rate = calls_per_hour / 3600.0
+        self.tokens = self.capacity
+        self.updated = _utcnow()
+
+    def _refill(self, now: datetime):
+        elapsed = (now - self.updated).total_seconds()
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def wait_time(self, calls: int, now: datetime) -> float:
+        """Seconds until `calls` tokens are available (0 if they are now)."""
+        self._refill(now)
+        missing = calls - self.tokens
+        return max(missing / self.rate, 0.0)
+
+    def spend(self, calls: int, now: datetime):
+        self._refill(now)
+        # Can go negative when a poll cost more than estimated; the debt is
+        # repaid before the next poll is allowed.
+        self.tokens -= calls
+
+
+class PollScheduler:
+    """Long-lived daemon that polls each user at its own adaptive interval."""
+
+    def __init__(self, bucket: TokenBucket | None = None):
+        self.bucket = bucket or TokenBucket()
+        self.schedules: dict[int, UserSchedule] = {}
+        self.heap: list[UserSchedule] = []
+        self.users: dict[int, dict] = {}
+        self.users_refreshed: Optional[datetime] = None
+        self.stop_event = threading.Event()
+
+    def refresh_users(self, conn):
+        """Pick up new signups and drop deleted, inactive or backed-off users."""
+        now = _utcnow()
+        users = {user["id"]: user for user in db.get_processable_users(conn=conn)}
+        activity = db.get_user_activity(conn, since=now - ACTIVITY_WINDOW)
+        conn.commit()
+
+        for user_id in users.keys() - self.schedules.keys():
+            stats = activity.get(user_id, {})
+            hours = ACTIVITY_WINDOW.total_seconds() / 3600
+            schedule = UserSchedule(
+                next_poll=now,
+                user_id=user_id,
+                plays_per_hour=stats.get("recent_plays", 0) / hours,
+                last_played_at=stats.get("last_played_at"),
+            )
+            self.schedules[user_id] = schedule
+            heapq.heappush(self.heap, schedule)
+
+        for user_id in self.schedules.keys() - users.keys():
+            del self.schedules[user_id]
+
+        self.users = users
+        self.users_refreshed = now
+        logging.info(f"Scheduling {len(self.schedules)} users")
+
+    def poll(self, conn, schedule: UserSchedule):
+        user = self.users[schedule.user_id]
+        after = None
+        if schedule.last_played_at is not None:
+            after = int(
+                schedule.last_played_at.replace(tzinfo=timezone.utc).timestamp()
+                * 1000
+            )
+
+        plays = artist_calls = 0
+        try:
+            batch = process_user(conn, user, after=after)
+            conn.commit()
+            plays, artist_calls = len(batch.plays), batch.artist_calls
+        except Exception as e:
+            conn.rollback()
+            logging.error(
+                f"Error processing user {user.get('spotify_user_id', 'unknown')}: {e}"
+            )
+            if record_failure(conn, user, e) is not None:
+                # Backed off or deactivated: drop until refresh_users
+                # finds the user eligible again
+                del self.schedules[schedule.user_id]
+
+        now = _utcnow()
+        self.bucket.spend(BASE_CALLS_PER_POLL + artist_calls, now)
+        if plays:
+            schedule.last_played_at = db.get_last_played_at(conn, schedule.user_id)
+            conn.commit()
+        schedule.observe(plays, now)
+        logging.info(
+            f"Polled user {schedule.user_id}: {plays} plays, "
+            f"{schedule.plays_per_hour:.1f}/h, next in "
+            f"{schedule.next_poll - now}"
+        )
+
+    def run(self):
+        conn = db.get_conn()
+        try:
+            while not self.stop_event.is_set():
+                now = _utcnow()
+                if (
+                    self.users_refreshed is None
+                    or now - self.users_refreshed > USER_REFRESH_INTERVAL
+                ):
+                    self.refresh_users(conn)
+
+                if not self.heap:
+                    self.stop_event.wait(USER_REFRESH_INTERVAL.total_seconds())
+                    continue
+
+                schedule = self.heap[0]
+                if self.schedules.get(schedule.user_id) is not schedule:
+                    heapq.heappop(self.heap)
+                    continue
+
+                wait = (schedule.next_poll - now).total_seconds()
+                wait = max(wait, self.bucket.wait_time(BASE_CALLS_PER_POLL, now))
+                if wait > 0:
+                    self.stop_event.wait(
+                        min(wait, USER_REFRESH_INTERVAL.total_seconds())
+                    )
+                    continue
+
+                heapq.heappop(self.heap)
+                self.poll(conn, schedule)
+                heapq.heappush(self.heap, schedule)
+        finally:
+            conn.close()
+            logging.info("Scheduler stopped")
+
+    def stop(self, *_):
+        self.stop_event.set()
+
+
+def main():
+    check_schema()
+    scheduler = PollScheduler()
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    scheduler.run()
+
+
+if __name__ == "__main__":
+    main()
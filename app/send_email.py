@@ -1,9 +1,8 @@
 # Work in progress
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
 from dotenv import load_dotenv
 import os
 from datetime import date
+from functools import lru_cache
 
 from .db import get_all_users
 from .generate_report import generate_user_weekly_report
@@ -11,8 +10,17 @@ from .generate_report import generate_user_weekly_report
 load_dotenv()
 
 
+@lru_cache(maxsize=1)
+def get_sendgrid_client():
+    from sendgrid import SendGridAPIClient
+
+    return SendGridAPIClient(os.getenv("SENDGRID_API_KEY"))
+
+
 def send_report(email: str, display_name: str, html_content: str):
     """Send a single report to a user."""
+    from sendgrid.helpers.mail import Mail
+
     message = Mail(
         from_email=os.getenv("EMAIL_ADDR"),
         to_emails=email,
@@ -20,8 +28,7 @@ def send_report(email: str, display_name: str, html_content: str):
         html_content=html_content,
     )
 
-    sg = SendGridAPIClient(os.getenv("SENDGRID_API_KEY"))
-    response = sg.send(message)
+    response = get_sendgrid_client().send(message)
     return (response.status_code, response.body)
 
 
@@ -0,0 +1,221 @@
+"""Redis-backed work queue for sharding the ETL across worker processes.
+
+Each user is a work item. Workers claim items with a time-limited lease,
+heartbeat while they work, and report completion or failure. Leases that
+expire (crashed or stalled worker) are put back on the queue until the
+item runs out of attempts.
+
+Keys (all under QUEUE_PREFIX):
+    pending   LIST  user ids waiting to be claimed
+    leases    ZSET  user id -> lease expiry (unix seconds)
+    owners    HASH  user id -> worker id holding the lease
+    attempts  HASH  user id -> number of claims so far
+    done      SET   user ids completed in this run
+    failed    SET   user ids that exhausted their attempts
+"""
+
+import os
+import time
+import socket
+import logging
+from typing import Optional
+
+import redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+QUEUE_PREFIX = os.getenv("ETL_QUEUE_PREFIX", "recapify:etl")
+LEASE_SECONDS = int(os.getenv("ETL_LEASE_SECONDS", 120))
+MAX_ATTEMPTS = int(os.getenv("ETL_MAX_ATTEMPTS", 3))
+
+
+# Pop one item and lease it in a single round trip so two workers can never
+# claim the same user.
+_CLAIM_LUA = """
+local user_id = redis.call('RPOP', KEYS[1])
+if not user_id then
+  return nil
+end
+redis.call('ZADD', KEYS[2], ARGV[1], user_id)
+redis.call('HSET', KEYS[3], user_id, ARGV[2])
+redis.call('HINCRBY', KEYS[4], user_id, 1)
+return user_id
+"""
+
+# Extend a lease only if the caller still owns it.
+_HEARTBEAT_LUA = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+  return 0
+end
+redis.call('ZADD', KEYS[1], 'XX', ARGV[3], ARGV[1])
+return 1
+"""
+
+# Release a lease held by the caller. ARGV[3] is the destination:
+# 'done' marks completion, 'retry' requeues or fails the item.
+_RELEASE_LUA = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+  return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+if ARGV[3] == 'done' then
+  redis.call('SADD', KEYS[5], ARGV[1])
+  return 1
+end
+local attempts = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+if attempts >= tonumber(ARGV[4]) then
+  redis.call('SADD', KEYS[6], ARGV[1])
+else
+  redis.call('LPUSH', KEYS[4], ARGV[1])
+end
+return 1
+"""
+
+# Requeue every item whose lease expired before ARGV[1].
+_REAP_LUA = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, user_id in ipairs(expired) do
+  redis.call('ZREM', KEYS[1], user_id)
+  redis.call('HDEL', KEYS[2], user_id)
+  local attempts = tonumber(redis.call('HGET', KEYS[3], user_id) or '0')
+  if attempts >= tonumber(ARGV[2]) then
+    redis.call('SADD', KEYS[6], user_id)
+  else
+    redis.call('LPUSH', KEYS[4], user_id)
+  end
+end
+return #expired
+"""
+
+
+def get_redis():
+    return redis.Redis.from_url(
+        os.getenv("REDIS_URL", "redis://localhost:6379/0"), decode_responses=True
+    )
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """Lease-based queue of user ids shared by every ETL worker."""
+
+    def __init__(
+        self,
+        client=None,
+        prefix: str = QUEUE_PREFIX,
+        lease_seconds: int = LEASE_SECONDS,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.redis = client if client is not None else get_redis()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.pending_key = f"{prefix}:pending"
+        self.leases_key = f"{prefix}:leases"
+        self.owners_key = f"{prefix}:owners"
+        self.attempts_key = f"{prefix}:attempts"
+        self.done_key = f"{prefix}:done"
+        self.failed_key = f"{prefix}:failed"
+        self._claim = self.redis.register_script(_CLAIM_LUA)
+        self._heartbeat = self.redis.register_script(_HEARTBEAT_LUA)
+        self._release = self.redis.register_script(_RELEASE_LUA)
+        self._reap = self.redis.register_script(_REAP_LUA)
+
+    def enqueue(self, user_ids) -> int:
+        """Start a new run with `user_ids` as its work items."""
+        user_ids = [str(user_id) for user_id in user_ids]
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(
+            self.pending_key,
+            self.leases_key,
+            self.owners_key,
+            self.attempts_key,
+            self.done_key,
+            self.failed_key,
+        )
+        if user_ids:
+            pipe.lpush(self.pending_key, *user_ids)
+        pipe.execute()
+        return len(user_ids)
+
+    def claim(self, worker_id: str) -> Optional[int]:
+        """Lease the next user for `worker_id`, or None if nothing is pending."""
+        self.reap_expired()
+        user_id = self._claim(
+            keys=[
+                self.pending_key,
+                self.leases_key,
+                self.owners_key,
+                self.attempts_key,
+            ],
+            args=[time.time() + self.lease_seconds, worker_id],
+        )
+        return int(user_id) if user_id is not None else None
+
+    def heartbeat(self, user_id: int, worker_id: str) -> bool:
+        """Extend the lease on `user_id`. False means the lease was lost."""
+        return bool(
+            self._heartbeat(
+                keys=[self.leases_key, self.owners_key],
+                args=[user_id, worker_id, time.time() + self.lease_seconds],
+            )
+        )
+
+    def complete(self, user_id: int, worker_id: str) -> bool:
+        return self._release_lease(user_id, worker_id, "done")
+
+    def fail(self, user_id: int, worker_id: str) -> bool:
+        """Give the item back; it is retried until it runs out of attempts."""
+        return self._release_lease(user_id, worker_id, "retry")
+
+    def _release_lease(self, user_id: int, worker_id: str, outcome: str) -> bool:
+        return bool(
+            self._release(
+                keys=[
+                    self.leases_key,
+                    self.owners_key,
+                    self.attempts_key,
+                    self.pending_key,
+                    self.done_key,
+                    self.failed_key,
+                ],
+                args=[user_id, worker_id, outcome, self.max_attempts],
+            )
+        )
+
+    def reap_expired(self) -> int:
+        """Requeue items whose worker stopped heartbeating."""
+        reaped = self._reap(
+            keys=[
+                self.leases_key,
+                self.owners_key,
+                self.attempts_key,
+                self.pending_key,
+                self.done_key,
+                self.failed_key,
+            ],
+            args=[time.time(), self.max_attempts],
+        )
+        if reaped:
+            logging.warning(f"Requeued {reaped} expired lease(s)")
+        return reaped
+
+    def is_drained(self) -> bool:
+        """True once nothing is pending and no lease is outstanding."""
+        pipe = self.redis.pipeline()
+        pipe.llen(self.pending_key)
+        pipe.zcard(self.leases_key)
+        pending, leased = pipe.execute()
+        return pending == 0 and leased == 0
+
+    def stats(self) -> dict:
+        pipe = self.redis.pipeline()
+        pipe.llen(self.pending_key)
+        pipe.zcard(self.leases_key)
+        pipe.scard(self.done_key)
+        pipe.scard(self.failed_key)
+        pending, leased, done, failed = pipe.execute()
+        return {"pending": pending, "leased": leased, "done": done, "failed": failed}
@@ -0,0 +1,222 @@
+"""Allocation and peak-RSS benchmark for building and rendering weekly reports.
+
+Builds synthetic cursor rows for a heavy listener and renders the weekly
+report with the row representation in app/aggregator.py ("lean"), and
+with the previous dict-of-dicts plus per-render sorts ("legacy") for
+comparison. For each representation it measures:
+
+  - peak Python allocations per report (tracemalloc), with and without
+    rendering the template
+  - peak RSS of a fresh process rendering REPORT_MEMORY_REPORTS reports
+    and keeping their data, as app/cache.py does
+
+It exits non-zero if the lean representation stops beating the legacy one
+by MAX_PEAK_RATIO. It needs no database.
+
+    python benchmarks/bench_report_memory.py
+    REPORT_MEMORY_TRACKS=5000 python benchmarks/bench_report_memory.py
+"""
+
+import os
+import sys
+import json
+import resource
+import subprocess
+import tracemalloc
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.aggregator import ArtistRow, TrackRow  # noqa: E402
+
+TRACKS = int(os.getenv("REPORT_MEMORY_TRACKS", 2000))
+ARTISTS = int(os.getenv("REPORT_MEMORY_ARTISTS", 400))
+REPORTS = int(os.getenv("REPORT_MEMORY_REPORTS", 200))
+# Lean peak allocations must stay below this fraction of legacy
+MAX_PEAK_RATIO = float(os.getenv("REPORT_MEMORY_MAX_RATIO", 0.6))
+
+
+def cursor_rows(seed: int = 0) -> tuple[list[tuple], list[tuple]]:
+    """Rows shaped like WEEKLY_TRACKS_SQL/WEEKLY_ARTISTS_SQL results."""
+    tracks = [
+        (
+            f"{seed:06d}track{i:011d}",
+            f"Track number {i}",
+            f"Artist {i % ARTISTS}",
+            f"{seed:06d}artist{i % ARTISTS:010d}",
+            f"https://i.scdn.co/image/ab67616d0000b273{i:024d}",
+            (i * 7919) % 23 + 1,
+        )
+        for i in range(TRACKS)
+    ]
+    artists = [
+        (
+            f"{seed:06d}artist{i:010d}",
+            f"Artist {i}",
+            f"https://i.scdn.co/image/ab6761610000e5eb{i:024d}",
+            (i * 104729) % 97 + 1,
+        )
+        for i in range(ARTISTS)
+    ]
+    # The SQL returns rows ranked; the legacy path sorted them itself
+    tracks.sort(key=lambda row: (-row[-1], row[0]))
+    artists.sort(key=lambda row: (-row[-1], row[0]))
+    return tracks, artists
+
+
+def build_lean(track_rows, artist_rows) -> dict:
+    return {
+        "tracks": tuple(TrackRow(*row) for row in track_rows),
+        "artists": tuple(ArtistRow(*row) for row in artist_rows),
+        "user": {"display_name": "Benchmark", "email": None},
+    }
+
+
+def build_legacy(track_rows, artist_rows) -> dict:
+    data = {"tracks": {}, "artists": {}, "user": None}
+    for track_id, name, artist_name, artist_id, album_image, count in track_rows:
+        data["tracks"][track_id] = {
+            "track_id": track_id,
+            "name": name,
+            "artist_name": artist_name,
+            "artist_id": artist_id,
+            "album_image": album_image,
+            "count": count,
+        }
+    for artist_id, name, artist_image, count in artist_rows:
+        data["artists"][artist_id] = {
+            "id": artist_id,
+            "name": name,
+            "artist_image": artist_image,
+            "count": count,
+        }
+    data["user"] = {"display_name": "Benchmark", "email": None}
+    return data
+
+
+def legacy_context(data: dict, top_n: int = 5) -> dict:
+    """The template variables as generate_html_report used to build them."""
+    by_count = lambda x: x["count"]  # noqa: E731
+    return {
+        "top_tracks": sorted(data["tracks"].values(), key=by_count, reverse=True)[:top_n],
+        "top_artists": sorted(data["artists"].values(), key=by_count, reverse=True)[:top_n],
+        "all_tracks": sorted(data["tracks"].values(), key=by_count, reverse=True),
+        "all_artists": sorted(data["artists"].values(), key=by_count, reverse=True),
+    }
+
+
+def render(mode: str, data: dict) -> str:
+    from app.generate_report import TEMPLATE_NAME, generate_html_report, setup_jinja_env
+
+    if mode == "lean":
+        return generate_html_report(data, today=date(2025, 4, 6))
+    template = setup_jinja_env().get_template(TEMPLATE_NAME)
+    return template.render(
+        user_display_name=data["user"]["display_name"],
+        year=2025,
+        week=14,
+        today=date(2025, 4, 6),
+        has_tracks=bool(data["tracks"]),
+        has_artists=bool(data["artists"]),
+        **legacy_context(data),
+    )
+
+
+def can_render() -> bool:
+    try:
+        import jinja2  # noqa: F401
+    except ImportError:
+        return False
+    return os.path.exists(os.path.join(ROOT, "templates", "weekly_report.html"))
+
+
+def one_report(mode: str, rows, with_render: bool):
+    if mode == "lean":
+        data = build_lean(*rows)
+        context = data
+    else:
+        data = build_legacy(*rows)
+        context = legacy_context(data)
+    if with_render:
+        return render(mode, data)
+    return context
+
+
+def peak_allocations(mode: str, rows, with_render: bool) -> int:
+    one_report(mode, rows, with_render)  # warm up caches (e.g. compiled template)
+    tracemalloc.start()
+    result = one_report(mode, rows, with_render)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def child(mode: str):
+    """Render REPORTS reports, keeping their data as the weekly data cache
+    would, and print this process's peak RSS (KiB)."""
+    with_render = can_render()
+    build = build_lean if mode == "lean" else build_legacy
+    kept = []
+    for i in range(REPORTS):
+        data = build(*cursor_rows(seed=i))
+        if with_render:
+            render(mode, data)
+        kept.append(data)
+    print(json.dumps({"maxrss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def peak_rss(mode: str) -> int:
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", mode],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])["maxrss_kib"]
+
+
+def main() -> int:
+    rows = cursor_rows()
+    stages = [("build + sort", False)]
+    if can_render():
+        stages.append(("build + render", True))
+    else:
+        print("jinja2 or template missing; skipping render measurements")
+
+    failures = []
+    print(f"{TRACKS} tracks, {ARTISTS} artists per report")
+    for label, with_render in stages:
+        legacy = peak_allocations("legacy", rows, with_render)
+        lean = peak_allocations("lean", rows, with_render)
+        ratio = lean / legacy
+        status = "ok"
+        # Rendering allocates the same HTML either way, so only gate the rows
+        if not with_render and ratio > MAX_PEAK_RATIO:
+            failures.append(
+                f"{label}: lean peak {lean} B is {ratio:.2f}x legacy (max {MAX_PEAK_RATIO})"
+            )
+            status = "REGRESSED"
+        print(
+            f"{label:<15} legacy {legacy / 1024:8.0f} KiB  lean {lean / 1024:8.0f} KiB"
+            f"  ({ratio:.2f}x)  {status}"
+        )
+
+    legacy_rss, lean_rss = peak_rss("legacy"), peak_rss("lean")
+    print(
+        f"peak RSS holding {REPORTS} reports: legacy {legacy_rss / 1024:.1f} MiB, "
+        f"lean {lean_rss / 1024:.1f} MiB"
+    )
+
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        child(sys.argv[2])
+        sys.exit(0)
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""Cold-start benchmark for the API and batch entry points.
+
+Imports each entry point in a fresh interpreter, takes the best of several
+runs, and exits non-zero if an import blows its time budget or pulls in a
+module that should only be loaded on demand.
+
+    python benchmarks/bench_startup.py
+    STARTUP_BUDGET_SCALE=2 python benchmarks/bench_startup.py  # slow CI box
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = int(os.getenv("STARTUP_RUNS", 5))
+BUDGET_SCALE = float(os.getenv("STARTUP_BUDGET_SCALE", 1.0))
+
+# entry module -> (import budget in ms, modules that must stay unloaded,
+# baseline module). With a baseline, the budget covers only the time added
+# on top of importing the baseline alone, so a framework whose own import
+# dominates (FastAPI) doesn't leave the check at the mercy of the runner.
+ENTRY_POINTS = {
+    "api.main": (
+        150,
+        ["spotipy", "sqlmodel", "sqlalchemy", "psycopg2", "ijson", "jinja2", "sendgrid"],
+        "fastapi",
+    ),
+    "api.db": (150, ["sqlmodel", "sqlalchemy"], None),
+    "run_etl": (250, ["spotipy", "sendgrid", "jinja2", "aiohttp"], None),
+    "send_report": (250, ["spotipy", "sendgrid", "jinja2", "numpy"], None),
+}
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure(module: str) -> tuple[float, set[str]]:
+    best = float("inf")
+    loaded: set[str] = set()
+    for _ in range(RUNS):
+        result = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module)],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        sample = json.loads(result.stdout.strip().splitlines()[-1])
+        best = min(best, sample["ms"])
+        loaded = set(sample["modules"])
+    return best, loaded
+
+
+def main() -> int:
+    failures = []
+    for module, (budget_ms, lazy_modules, baseline) in ENTRY_POINTS.items():
+        budget_ms *= BUDGET_SCALE
+        elapsed_ms, loaded = measure(module)
+        added_ms = elapsed_ms
+        over = ""
+        if baseline is not None:
+            baseline_ms, _ = measure(baseline)
+            added_ms = elapsed_ms - baseline_ms
+            over = f" over {baseline} ({baseline_ms:.0f} ms)"
+        eager = [name for name in lazy_modules if name in loaded]
+        status = "ok"
+        if added_ms > budget_ms:
+            failures.append(
+                f"{module}: {added_ms:.0f} ms{over} > {budget_ms:.0f} ms budget"
+            )
+            status = "SLOW"
+        if eager:
+            failures.append(f"{module}: imports {', '.join(eager)} eagerly")
+            status = "EAGER"
+        print(
+            f"{module:<12} {added_ms:7.1f} ms{over}  (budget {budget_ms:.0f} ms)  {status}"
+        )
+
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
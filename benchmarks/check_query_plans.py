@@ -0,0 +1,102 @@
+"""Assert the weekly aggregation queries use the indexes built for them.
+
+Runs EXPLAIN on `load_weekly_data`'s queries against the configured
+database and fails unless every scan of plays/tracks/artists is an Index
+Only Scan on the intended index. Run it after `python migrate.py` against
+a database with representative data:
+
+    python benchmarks/check_query_plans.py
+
+Sequential scans are disabled for the check so a small test database still
+shows which index the planner would pick. The tables are VACUUMed first so
+the visibility map allows index-only scans.
+"""
+
+import os
+import sys
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db import get_conn  # noqa: E402
+from app.aggregator import (  # noqa: E402
+    WEEKLY_ARTISTS_SQL,
+    WEEKLY_TRACKS_SQL,
+    get_week_range,
+)
+
+EXPECTED_INDEXES = {
+    "plays": "uq_plays_user_time_track",
+    "tracks": "idx_tracks_cover",
+    "artists": "idx_artists_cover",
+}
+QUERIES = {
+    "weekly top tracks": WEEKLY_TRACKS_SQL,
+    "weekly top artists": WEEKLY_ARTISTS_SQL,
+}
+
+
+def scan_nodes(plan: dict):
+    """Yield every node in an EXPLAIN (FORMAT JSON) plan that reads a table."""
+    if "Relation Name" in plan:
+        yield plan
+    for child in plan.get("Plans", []):
+        yield from scan_nodes(child)
+
+
+def check_plan(name: str, plan: dict) -> list[str]:
+    problems = []
+    seen = set()
+    for node in scan_nodes(plan):
+        relation = node["Relation Name"]
+        expected = EXPECTED_INDEXES.get(relation)
+        if expected is None:
+            continue
+        seen.add(relation)
+        actual = f"{node['Node Type']} using {node.get('Index Name', '-')}"
+        status = "ok"
+        if node["Node Type"] != "Index Only Scan" or node.get("Index Name") != expected:
+            problems.append(
+                f"{name}: {relation} read by {actual}, expected Index Only Scan using {expected}"
+            )
+            status = "UNEXPECTED"
+        print(f"  {relation:<8} {actual}  {status}")
+    for relation in sorted(EXPECTED_INDEXES.keys() - seen):
+        problems.append(f"{name}: {relation} not found in plan")
+    return problems
+
+
+def main() -> int:
+    conn = get_conn()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("VACUUM ANALYZE plays, tracks, artists")
+            cur.execute("SELECT user_id, MAX(played_at) FROM plays GROUP BY user_id LIMIT 1")
+            row = cur.fetchone()
+        # Any real user/week will do; the plan shape is what matters
+        user_id, last_play = row if row else (1, date.today())
+        week_start, week_end = get_week_range(last_play)
+
+        conn.autocommit = False
+        problems = []
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL enable_seqscan = off")
+            for name, sql in QUERIES.items():
+                cur.execute(
+                    "EXPLAIN (FORMAT JSON) " + sql, (user_id, week_start, week_end)
+                )
+                plan = cur.fetchone()[0][0]["Plan"]
+                print(name)
+                problems += check_plan(name, plan)
+        conn.rollback()
+    finally:
+        conn.close()
+
+    for problem in problems:
+        print(f"FAIL {problem}", file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
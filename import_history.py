@@ -0,0 +1,25 @@
+import argparse
+import logging
+from app.migrations import check_schema
+from app.history_import import import_history, BATCH_SIZE
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import a Spotify extended streaming history export"
+    )
+    parser.add_argument("spotify_user_id", help="Spotify ID of a signed-up user")
+    parser.add_argument("path", help="Export zip, extracted folder or JSON file")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    check_schema()
+    logging.info(f"Importing streaming history for {args.spotify_user_id}...")
+    import_history(args.spotify_user_id, args.path, batch_size=args.batch_size)
+    logging.info("History import finished.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import logging
+from app import migrations
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    logging.info("Applying database migrations...")
+    applied = migrations.migrate()
+    if applied:
+        logging.info(f"Applied migrations: {applied}")
+    logging.info(f"Database schema is at version {migrations.LATEST_VERSION}.")
+
+
+if __name__ == "__main__":
+    main()
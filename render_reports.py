@@ -0,0 +1,37 @@
+import argparse
+import logging
+from datetime import date
+from app.bulk_render import PROCESSES, render_week_archive
+from app.generate_report import ensure_template_dir_exists
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    this_year, this_week, _ = date.today().isocalendar()
+    parser = argparse.ArgumentParser(
+        description="Render every user's weekly report into a .tar.gz archive"
+    )
+    parser.add_argument("--year", type=int, default=this_year)
+    parser.add_argument("--week", type=int, default=this_week, help="ISO week number")
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--processes", type=int, default=PROCESSES)
+    parser.add_argument("--out", help="Archive path (default reports/weekly_reports_<year>_w<week>.tar.gz)")
+    args = parser.parse_args()
+
+    if not ensure_template_dir_exists():
+        logging.error("Template not found. Aborting render.")
+        return
+
+    logging.info(f"Rendering reports for {args.year}-W{args.week:02d}...")
+    render_week_archive(
+        args.year,
+        args.week,
+        out=args.out,
+        top_n=args.top_n,
+        processes=args.processes,
+    )
+
+
+if __name__ == "__main__":
+    main()
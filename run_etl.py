@@ -1,3 +1,4 @@
+import argparse
 import logging
 from app import pull_data
 
@@ -5,8 +6,20 @@ logging.basicConfig(level=logging.INFO)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Pull recent plays for every user")
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Fetch users concurrently with the asyncio client (or set ETL_ASYNC=1)",
+    )
+    args = parser.parse_args()
+
     logging.info("Starting daily Spotify ETL job...")
-    pull_data.main()
+    if args.use_async:
+        pull_data.main(use_async=True)
+    else:
+        pull_data.main()
     logging.info("Daily ETL job finished successfully.")
 
 
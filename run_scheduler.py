@@ -0,0 +1,14 @@
+import logging
+from app import scheduler
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    logging.info("Starting adaptive Spotify polling daemon...")
+    scheduler.main()
+    logging.info("Polling daemon exited.")
+
+
+if __name__ == "__main__":
+    main()
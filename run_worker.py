@@ -0,0 +1,31 @@
+import argparse
+import logging
+from app import pull_data
+from app.migrations import check_schema
+from app.work_queue import WorkQueue, default_worker_id
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed Spotify ETL worker")
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="Seed the queue with every user before working",
+    )
+    parser.add_argument("--worker-id", default=default_worker_id())
+    args = parser.parse_args()
+
+    queue = WorkQueue()
+    if args.enqueue:
+        check_schema()
+        pull_data.enqueue_all_users(queue)
+
+    logging.info(f"Starting ETL worker {args.worker_id}...")
+    pull_data.run_worker(queue, args.worker_id)
+    logging.info("ETL worker finished.")
+
+
+if __name__ == "__main__":
+    main()
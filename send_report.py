@@ -1,6 +1,7 @@
 import logging
 from app.send_email import send_reports_for_all_users
 from app.generate_report import ensure_template_dir_exists
+from app.cache import invalidation_listener
 
 
 logging.basicConfig(level=logging.INFO)
@@ -14,8 +15,10 @@ def main():
         logging.error("Template not found. Aborting send.")
         return
 
-    # Send personalized HTML emails to all users
-    send_reports_for_all_users()
+    # Send personalized HTML emails to all users; the listener keeps the
+    # weekly data cache honest if plays land while the job is running
+    with invalidation_listener():
+        send_reports_for_all_users()
 
     logging.info("Weekly Spotify report sent successfully.")
 
@@ -0,0 +1,54 @@
+import os
+import json
+import argparse
+import logging
+from datetime import date
+from app import db
+from app.aggregator import refresh_weekly_rollups
+from app.recap import TOP_K, iter_range_recaps, year_range
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compute every user's recap for a year or date range"
+    )
+    parser.add_argument("--year", type=int, default=date.today().year - 1)
+    parser.add_argument("--start", type=date.fromisoformat, help="Overrides --year")
+    parser.add_argument("--end", type=date.fromisoformat, help="Exclusive end date")
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    parser.add_argument(
+        "--rebuild-rollups",
+        action="store_true",
+        help="Recompute weekly rollups from plays first (e.g. after upgrading)",
+    )
+    parser.add_argument("--out", help="JSON Lines output file")
+    args = parser.parse_args()
+
+    start, end = year_range(args.year)
+    if args.start:
+        start, end = args.start, args.end or date.today()
+    out = args.out or os.path.join("reports", f"recaps_{start}_{end}.jsonl")
+
+    if args.rebuild_rollups:
+        logging.info("Rebuilding weekly rollups...")
+        conn = db.get_conn()
+        try:
+            refresh_weekly_rollups(conn)
+            conn.commit()
+        finally:
+            conn.close()
+
+    logging.info(f"Computing recaps for {start} to {end}...")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    count = 0
+    with open(out, "w", encoding="utf-8") as f:
+        for recap in iter_range_recaps(start, end, top_k=args.top_k):
+            f.write(json.dumps(recap, default=str) + "\n")
+            count += 1
+    logging.info(f"Wrote {count} recaps to {out}")
+
+
+if __name__ == "__main__":
+    main()